@@ -2,28 +2,144 @@
 
 import sys
 import json
+import time
 
 sys.path.insert(0, 'src') # add library code to path
-from src.etl import get_data, process_data, extract_article, remove_dir
-from src.m_stat import get_m_stat_data, grab_m_stat_over_time
 
 DATA_PARAMS = 'config/data-params.json'
 PROCESS_PARAMS = 'config/process-params.json'
 M_STAT_PARAMS = 'config/m-stat-params.json'
 EXTRACT_PARAMS = 'config/extract-params.json'
+PROCESS_M_STAT_PARAMS = 'config/process-m-stat-params.json'
+BENCHMARK_PARAMS = 'config/benchmark-params.json'
+IMPORT_TIME_PARAMS = 'config/import-time-params.json'
+PARSER_BENCHMARK_PARAMS = 'config/parser-benchmark-params.json'
+SERVE_PARAMS = 'config/serve-params.json'
+LOAD_TEST_PARAMS = 'config/load-test-params.json'
 OVER_TIME_DATA_PARAMS = 'config/over-time/data-params.json'
 OVER_TIME_PROCESS_PARAMS = 'config/over-time/process-params.json'
 OVER_TIME_M_STAT_PARAMS = 'config/over-time/m-stat-params.json'
+OVER_TIME_QUERY_PARAMS = 'config/over-time/query-params.json'
 TEST_DATA_PARAMS = 'config/test/data-params.json'
 TEST_PROCESS_PARAMS = 'config/test/process-params.json'
 TEST_M_STAT_PARAMS = 'config/test/m-stat-params.json'
+TEST_PROCESS_M_STAT_PARAMS = 'config/test/process-m-stat-params.json'
 LIGHT_DUMP_DATA_PARAMS = 'config/light-dump/data-params.json'
 LIGHT_DUMP_EXTRACT_PARAMS = 'config/light-dump/extract-params.json'
 LIGHT_DUMP_M_STAT_PARAMS = 'config/light-dump/m-stat-params.json'
 LIGHT_DUMP_TIME_PARAMS = 'config/light-dump/over-time-m-stat-params.json'
-DEEP_SEARCH_DATA_PARAMS = 'config/deep-search/data-params.json'
-DEEP_SEARCH_PROCESS_PARAMS = 'config/deep-search/process-params.json'
-DEEP_SEARCH_M_STAT_PARAMS = 'config/deep-search/m-stat-params.json'
+DEEP_SEARCH_WORKER_PARAMS = 'config/deep-search/worker-params.json'
+DEEP_SEARCH_MERGE_PARAMS = 'config/deep-search/merge-params.json'
+TEST_QUEUE_PARAMS = 'config/test/queue-params.json'
+
+# Drivers are given as 'module:function' and only imported when a target
+# that uses them runs, so light targets don't pay for pandas/lxml/py7zr
+GET_DATA = 'src.etl:get_data'
+PROCESS_DATA = 'src.etl:process_data'
+EXTRACT_ARTICLE = 'src.etl:extract_article'
+GET_M_STAT_DATA = 'src.m_stat:get_m_stat_data'
+GET_M_STAT_FROM_XML = 'src.m_stat:get_m_stat_from_xml'
+GRAB_M_STAT_OVER_TIME = 'src.m_stat:grab_m_stat_over_time'
+RUN_WORKER = 'src.work_queue:run_worker'
+MERGE_M_STATS = 'src.work_queue:merge_m_stats'
+RUN_LOCAL_WORKERS = 'src.work_queue:run_local_workers'
+QUERY_M_STAT = 'src.snapshots:query_m_stat'
+REMOVE_DIR = 'shutil:rmtree'
+
+# Records of the stages run so far, for skipping up to date stages
+STAGE_MANIFEST = 'data/stage-manifest.json'
+# Most stages run at once (override with --jobs=N)
+STAGE_JOBS = 2
+
+# Files read and written by each driver's stages, so stages whose inputs,
+# outputs and params are unchanged since their last run are skipped and
+# stages that share no files run at the same time. Stages of any other
+# driver always run, on their own
+STAGE_IO = {
+    GET_DATA: 'src.stages:get_data_io',
+    PROCESS_DATA: 'src.stages:process_data_io',
+    EXTRACT_ARTICLE: 'src.stages:extract_article_io',
+    GET_M_STAT_DATA: 'src.stages:get_m_stat_data_io',
+    GET_M_STAT_FROM_XML: 'src.stages:get_m_stat_from_xml_io',
+    GRAB_M_STAT_OVER_TIME: 'src.stages:grab_m_stat_over_time_io',
+}
+
+
+def remove_dir_stage(dir_to_remove):
+    """
+    Stage for removing a directory
+    :param dir_to_remove: Directory to remove
+    :return: Stage
+    """
+    return REMOVE_DIR, {'path': dir_to_remove, 'ignore_errors': True}
+
+
+# Target registry: each target is a list of stages, where each stage is the
+# driver and either its params file or the params themselves. Targets run in
+# the order they are registered here
+TARGETS = {
+    # make the clean target
+    'clean': [remove_dir_stage('data/raw'), remove_dir_stage('data/temp'),
+              remove_dir_stage('data/out'),
+              remove_dir_stage('data/out_m_stat')],
+    # make the data target
+    'data': [(GET_DATA, DATA_PARAMS)],
+    # make the test data target
+    'test-data': [(GET_DATA, TEST_DATA_PARAMS)],
+    # cleans and prepares the data for analysis
+    'process': [(PROCESS_DATA, PROCESS_PARAMS)],
+    # cleans and prepares the test data for analysis
+    'test-process': [(PROCESS_DATA, TEST_PROCESS_PARAMS)],
+    # runs m-statistic on processed data
+    'm-stat': [(GET_M_STAT_DATA, M_STAT_PARAMS)],
+    # runs m-statistic on processed test data
+    'test-m-stat': [(GET_M_STAT_DATA, TEST_M_STAT_PARAMS)],
+    # processes the data and runs m-statistic in a single pass
+    'process-m-stat': [(GET_M_STAT_FROM_XML, PROCESS_M_STAT_PARAMS)],
+    # processes the test data and runs m-statistic in a single pass
+    'test-process-m-stat': [(GET_M_STAT_FROM_XML,
+                             TEST_PROCESS_M_STAT_PARAMS)],
+    # m-statistic for entire light dump
+    'light-dump': [(GET_DATA, LIGHT_DUMP_DATA_PARAMS),
+                   (EXTRACT_ARTICLE, LIGHT_DUMP_EXTRACT_PARAMS),
+                   (GET_M_STAT_DATA, LIGHT_DUMP_M_STAT_PARAMS),
+                   (GRAB_M_STAT_OVER_TIME, LIGHT_DUMP_TIME_PARAMS)],
+    # Searches through all the files from Wikimedia in the deep search
+    # manifest starting with enwiki-20200201-pages-meta-history1.xml, then
+    # merges the M-Statistics of every part
+    'deep-search': [(RUN_WORKER, DEEP_SEARCH_WORKER_PARAMS),
+                    (MERGE_M_STATS, DEEP_SEARCH_MERGE_PARAMS)],
+    # Works through the deep search manifest alongside workers on other
+    # machines sharing the queue directory
+    'queue-worker': [(RUN_WORKER, DEEP_SEARCH_WORKER_PARAMS)],
+    # Merges the M-Statistics of every part once all workers are done
+    'queue-merge': [(MERGE_M_STATS, DEEP_SEARCH_MERGE_PARAMS)],
+    # Runs several local workers against the test queue and merges them
+    'test-queue': [remove_dir_stage('data/test-queue'),
+                   (RUN_LOCAL_WORKERS, TEST_QUEUE_PARAMS)],
+    # Complete project for generating M-Statistic Evolution
+    'm-stat-time': [(GET_DATA, OVER_TIME_DATA_PARAMS),
+                    (PROCESS_DATA, OVER_TIME_PROCESS_PARAMS),
+                    (EXTRACT_ARTICLE, EXTRACT_PARAMS),
+                    (GRAB_M_STAT_OVER_TIME, OVER_TIME_M_STAT_PARAMS)],
+    # M-Statistic of an article at points in time from its snapshots
+    'm-stat-query': [(QUERY_M_STAT, OVER_TIME_QUERY_PARAMS)],
+    # Benchmarks the light dump parser and the import time of each module
+    'benchmark': [('src.benchmark:benchmark_parser', BENCHMARK_PARAMS),
+                  ('src.benchmark:benchmark_import_time',
+                   IMPORT_TIME_PARAMS)],
+    # Benchmarks converting the XML with each parser
+    'parser-benchmark': [('src.benchmark:benchmark_xml_parsers',
+                          PARSER_BENCHMARK_PARAMS)],
+    # Serves lookups of the M-Statistic results over HTTP/JSON
+    'serve': [('src.serve:serve', SERVE_PARAMS)],
+    # Load tests a local instance of the M-Statistic service
+    'load-test': [('src.benchmark:benchmark_serve', LOAD_TEST_PARAMS)],
+    # Complete project for test set
+    'test-project': [(GET_DATA, TEST_DATA_PARAMS),
+                     (PROCESS_DATA, TEST_PROCESS_PARAMS),
+                     (GET_M_STAT_DATA, TEST_M_STAT_PARAMS)],
+}
 
 
 def load_params(fp):
@@ -33,103 +149,196 @@ def load_params(fp):
     return param
 
 
-def main(targets):
+def load_driver(driver):
+    """
+    Imports the module of a driver and gets the driver function
+    :param driver: Driver given as 'module:function'
+    :return: Driver function
+    """
+    from importlib import import_module
 
-    # make the clean target
-    if 'clean' in targets:
-        remove_dir('data/raw')
-        remove_dir('data/temp')
-        remove_dir('data/out')
-        remove_dir('data/out_m_stat')
+    module, func = driver.split(':')
+    return getattr(import_module(module), func)
 
-    # make the data target
-    if 'data' in targets:
-        cfg = load_params(DATA_PARAMS)
-        get_data(**cfg)
 
-    # make the test data target
-    if 'test-data' in targets:
-        cfg = load_params(TEST_DATA_PARAMS)
-        get_data(**cfg)
+def run_stage(driver, params):
+    """
+    Runs a single stage of a target
+    :param driver: Driver given as 'module:function'
+    :param params: Params file path or the params themselves
+    :return: Seconds taken by the stage
+    """
+    start = time.perf_counter()
+    cfg = load_params(params) if isinstance(params, str) else params
+    load_driver(driver)(**cfg)
+    return time.perf_counter() - start
 
-    # cleans and prepares the data for analysis
-    if 'process' in targets:
-        cfg = load_params(PROCESS_PARAMS)
-        process_data(**cfg)
 
-    # cleans and prepares the test data for analysis
-    if 'test-process' in targets:
-        cfg = load_params(TEST_PROCESS_PARAMS)
-        process_data(**cfg)
+def make_stage(driver, params):
+    """
+    Gets everything needed to schedule a stage
+    :param driver: Driver given as 'module:function'
+    :param params: Params file path or the params themselves
+    :return: Dictionary of the stage's name, driver and params, plus the
+             hash of its params and its files for tracked drivers
+    """
+    stage = {
+        'name': '{} {}'.format(driver, params if isinstance(params, str)
+                               else json.dumps(params, sort_keys=True)),
+        'driver': driver, 'cfg': params, 'files': None
+    }
+    if driver in STAGE_IO:
+        from inspect import signature
 
-    # runs m-statistic on processed data
-    if 'm-stat' in targets:
-        cfg = load_params(M_STAT_PARAMS)
-        get_m_stat_data(**cfg)
+        # Fills in the driver's defaults, so changing one reruns the stage
+        cfg = load_params(params) if isinstance(params, str) else params
+        bound = signature(load_driver(driver)).bind(**cfg)
+        bound.apply_defaults()
+        stage['cfg'] = dict(bound.arguments)
+        stage['hash'] = load_driver('src.stages:hash_params')(
+            driver, stage['cfg'])
+        stage['files'] = get_stage_files(stage)
+    return stage
 
-    # runs m-statistic on processed test data
-    if 'test-m-stat' in targets:
-        cfg = load_params(TEST_M_STAT_PARAMS)
-        get_m_stat_data(**cfg)
 
-    # m-statistic for entire light dump
-    if 'light-dump' in targets:
-        data_cfg = load_params(LIGHT_DUMP_DATA_PARAMS)
-        extract_cfg = load_params(LIGHT_DUMP_EXTRACT_PARAMS)
-        m_stat_cfg = load_params(LIGHT_DUMP_M_STAT_PARAMS)
-        evolution_cfg = load_params(LIGHT_DUMP_TIME_PARAMS)
-
-        get_data(**data_cfg)
-        extract_article(**extract_cfg)
-        get_m_stat_data(**m_stat_cfg)
-        grab_m_stat_over_time(**evolution_cfg)
-
-    # Searches through all thee files from Wikimedia starting with
-    # enwiki-20200201-pages-meta-history1.xml
-    if 'deep-search' in targets:
-        for i in range(6):
-            data_cfg =\
-                load_params(DEEP_SEARCH_DATA_PARAMS
-                            .replace('params', 'params-' + str(i + 1)))
-            process_cfg =\
-                load_params(DEEP_SEARCH_PROCESS_PARAMS
-                            .replace('params', 'params-' + str(i + 1)))
-            m_stat_cfg =\
-                load_params(DEEP_SEARCH_M_STAT_PARAMS
-                            .replace('params', 'params-' + str(i + 1)))
-
-            get_data(**data_cfg)
-            remove_dir('data/raw')
-            process_data(**process_cfg)
-            remove_dir('data/temp')
-            get_m_stat_data(**m_stat_cfg)
-            remove_dir('data/out')
+def get_stage_files(stage):
+    """
+    :param stage: Stage from make_stage() of a tracked driver
+    :return: Files read and written by the stage
+    """
+    return load_driver(STAGE_IO[stage['driver']])(**stage['cfg'])
 
-    # Complete project for generating M-Statistic Evolution
-    if 'm-stat-time' in targets:
-        data_cfg = load_params(OVER_TIME_DATA_PARAMS)
-        process_cfg = load_params(OVER_TIME_PROCESS_PARAMS)
-        extract_cfg = load_params(EXTRACT_PARAMS)
-        evolution_cfg = load_params(OVER_TIME_M_STAT_PARAMS)
 
-        get_data(**data_cfg)
-        process_data(**process_cfg)
-        extract_article(**extract_cfg)
-        grab_m_stat_over_time(**evolution_cfg)
+def get_stage_deps(stages):
+    """
+    Gets the earlier stages each stage has to wait on. Untracked stages wait
+    on and are waited on by every other stage
+    :param stages: Stages in the order they are registered
+    :return: Set of indexes of the stages each stage waits on
+    """
+    depends_on = load_driver('src.stages:depends_on')
+    return [{j for j in range(i)
+             if stage['files'] is None or stages[j]['files'] is None or
+             depends_on(stage['files'], stages[j]['files'])}
+            for i, stage in enumerate(stages)]
 
-    # Complete project for test set
-    if 'test-project' in targets:
-        data_cfg = load_params(TEST_DATA_PARAMS)
-        process_cfg = load_params(TEST_PROCESS_PARAMS)
-        m_stat_cfg = load_params(TEST_M_STAT_PARAMS)
 
-        get_data(**data_cfg)
-        process_data(**process_cfg)
-        get_m_stat_data(**m_stat_cfg)
+def run_stages(stages, force=0, jobs=STAGE_JOBS):
+    """
+    Runs stages in dependency order, skipping the up to date ones and
+    running independent ones in separate processes at the same time
+    :param stages: Stages from make_stage() in the order they are registered
+    :param force: Whether or not to rerun stages that are up to date
+    :param jobs: Most stages to run at once
+    :return: List of [stage name, status, seconds] for every stage
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor,\
+        wait
+
+    is_up_to_date = load_driver('src.stages:is_up_to_date')
+    make_record = load_driver('src.stages:make_record')
+    save_stage_manifest = load_driver('src.stages:save_stage_manifest')
+    manifest = load_driver('src.stages:load_stage_manifest')(STAGE_MANIFEST)
+    deps = get_stage_deps(stages)
+    pending, running, timings, error = list(range(len(stages))), {}, [], None
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            unfinished = set(pending) | set(running.values())
+            ready = [i for i in pending
+                     if error is None and not deps[i] & unfinished]
+            for i in ready:
+                pending.remove(i)
+                stage = stages[i]
+                if stage['files'] is None:
+                    # Nothing else is running, as it waits on every stage
+                    timings.append([stage['name'], 'ran',
+                                    run_stage(stage['driver'], stage['cfg'])])
+                    continue
+                # Earlier stages may have changed its files since the start
+                stage['files'] = get_stage_files(stage)
+                if not force and is_up_to_date(manifest.get(stage['name']),
+                                               stage['hash'],
+                                               stage['files']):
+                    print('Up to date:', stage['name'])
+                    timings.append([stage['name'], 'up to date', 0])
+                    continue
+                print('Starting:', stage['name'])
+                running[pool.submit(run_stage, stage['driver'],
+                                    stage['cfg'])] = i
+
+            if not running:
+                if not ready:
+                    break
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = stages[running.pop(future)]
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    print('Failed:', stage['name'])
+                    timings.append([stage['name'], 'failed', 0])
+                    error = error or e
+                    continue
+                # Recorded once it finishes, with the files it actually wrote
+                manifest[stage['name']] = make_record(
+                    stage['hash'], get_stage_files(stage), seconds)
+                save_stage_manifest(STAGE_MANIFEST, manifest)
+                timings.append([stage['name'], 'ran', seconds])
+
+    if error is not None:
+        print_stage_timings(timings)
+        raise error
+    return timings
+
+
+def print_stage_timings(timings):
+    """
+    Reports how long each stage took
+    :param timings: List of [stage name, status, seconds] from run_stages()
+    """
+    print('Stage timings:')
+    for name, status, seconds in timings:
+        print('{:>10.2f}s  {:<10}  {}'.format(seconds, status, name))
+
+
+def main(targets, force=0, jobs=STAGE_JOBS):
+    """
+    Runs the stages of every target given, skipping up to date stages
+    :param targets: Names of targets to run
+    :param force: Whether or not to rerun stages that are up to date
+    :param jobs: Most stages to run at once
+    """
+
+    for target in targets:
+        if target not in TARGETS:
+            print('Unknown target:', target)
+
+    # Stages shared by several of the targets run once
+    stages, names = [], set()
+    for target, target_stages in TARGETS.items():
+        if target in targets:
+            for driver, params in target_stages:
+                stage = make_stage(driver, params)
+                if stage['name'] not in names:
+                    names.add(stage['name'])
+                    stages.append(stage)
+
+    start = time.perf_counter()
+    timings = run_stages(stages, force=force, jobs=jobs)
+    print_stage_timings(timings)
+    print('Total: {:.2f}s'.format(time.perf_counter() - start))
 
     return
 
 
 if __name__ == '__main__':
-    targets = sys.argv[1:]
-    main(targets)
+    # Options: --force to rerun up to date stages, --jobs=N for the most
+    # stages to run at once
+    args = sys.argv[1:]
+    targets = [arg for arg in args if not arg.startswith('--')]
+    jobs = [int(arg.split('=')[1]) for arg in args
+            if arg.startswith('--jobs=')]
+    main(targets, force='--force' in args,
+         jobs=jobs[-1] if jobs else STAGE_JOBS)
@@ -0,0 +1,369 @@
+import glob
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.client import HTTPConnection
+from multiprocessing import Process
+from urllib.parse import urlencode
+from editors import EditorIds
+from light_io import get_compression, get_xml_light_dump_name,\
+    open_light_dump, resolve_light_dump
+from m_stat import iter_light_dump_pages
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for Benchmarking
+# ---------------------------------------------------------------------
+
+def time_best_of(func, repeat):
+    """
+    Times a function, keeping the best of several runs
+    :param func: Function to time
+    :param repeat: Number of runs
+    :return: Best time in seconds and the result of the last run
+    """
+    best, res = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def baseline_update_line(line, editor_mapper, editor_count, num_edits_dict,
+                         editor_order, rev_order):
+    """
+    update_line() as it was before the block parser, kept as the baseline
+    Splits the whole line and maps editors to ids unique to the article
+    :param line: Current line in light dump
+    :param editor_mapper: Maps editors to a unique identifier
+    :param editor_count: Number of editors seen thus far in an article
+    :param num_edits_dict: Maps editor id to number of respective edits
+    :param editor_order: Ordering so far of editor
+    :param rev_order: Revision order
+    :return: Updated number of editors
+    """
+    line = line.split()
+    if line[3] not in editor_mapper:
+        editor_mapper[line[3]] = editor_count
+        num_edits_dict[editor_mapper[line[3]]] = 0
+        editor_count += 1
+    num_edits_dict[editor_mapper[line[3]]] += 1
+    editor_order.append(editor_mapper[line[3]])
+    rev_order.append(int(line[2]))
+    return editor_count
+
+
+def parse_line_loop(fp):
+    """
+    Parses the light dump one line at a time, the way get_m_stat_data()
+    originally did
+    :param fp: File path of the light dump
+    :return: Revision order and editor order of every page
+    """
+    fp = resolve_light_dump(fp)
+    pages = []
+    editor_order, num_edits_dict, editor_mapper, rev_order, editor_count = \
+        [], {}, {}, [], 0
+    # Plain light dumps are read with open() like before, compressed ones
+    # did not exist back then
+    fh = open_light_dump(fp) if get_compression(fp) else open(fp)
+    with fh:
+        for line in fh:
+            line = line.rstrip()
+            if '^^^' != line[:3]:
+                editor_order, num_edits_dict, editor_mapper, rev_order = \
+                    [], {}, {}, []
+                editor_count = 0
+                pages.append((rev_order, editor_order))
+                continue
+            editor_count = baseline_update_line(line, editor_mapper,
+                                                editor_count, num_edits_dict,
+                                                editor_order, rev_order)
+    return pages
+
+
+def renumber_editors(editor_order):
+    """
+    Renumbers editors in order of first appearance, which is how the
+    original per article mapper assigned ids
+    :param editor_order: Editor ids of a page
+    :return: Editor ids unique to the page
+    """
+    editor_mapper = {}
+    return [editor_mapper.setdefault(editor_id, len(editor_mapper))
+            for editor_id in editor_order]
+
+
+def parse_blocks(fp):
+    """
+    Parses the light dump in large chunks with iter_light_dump_pages()
+    :param fp: File path of the light dump
+    :return: Revision order and editor order of every page
+    """
+    editor_ids = EditorIds()
+    with open_light_dump(fp, binary=True) as fh:
+        return [(rev_order, editor_order) for _, _, rev_order, editor_order, _
+                in iter_light_dump_pages(fh, editor_ids)]
+
+
+# ---------------------------------------------------------------------
+# Driver Function for BENCHMARKING THE LIGHT DUMP PARSER
+# ---------------------------------------------------------------------
+
+def benchmark_parser(data_dir='data/',
+                     fps=("light-dump-enwiki-20200201-pages-meta-history13-" +
+                          "xml-p5136923p5137305.txt",),
+                     repeat=3):
+    """
+    Compares the lines/sec of the original line by line parser against
+    the block parser used by get_m_stat_data()
+    :param data_dir: Directory for data
+    :param fps: File paths of light dumps to parse
+    :param repeat: Number of runs for each parser, keeping the best
+    """
+    out_dir = '{}out/'.format(data_dir)
+
+    for fp in fps:
+        with open_light_dump(out_dir + fp, binary=True) as fh:
+            num_lines = sum(chunk.count(b'\n')
+                            for chunk in iter(lambda: fh.read(1 << 20), b''))
+        print('Parsing {} ({} lines)'.format(fp, num_lines))
+
+        line_time, line_pages = time_best_of(
+            lambda: parse_line_loop(out_dir + fp), repeat)
+        block_time, block_pages = time_best_of(
+            lambda: parse_blocks(out_dir + fp), repeat)
+
+        # The line loop numbers editors per article, the block parser globally
+        block_pages = [(rev_order, renumber_editors(editor_order))
+                       for rev_order, editor_order in block_pages]
+        if line_pages != block_pages:
+            print('Parsers disagree on', fp)
+        print('Line loop:    {:>12,.0f} lines/sec'.format(
+            num_lines / line_time))
+        print('Block parser: {:>12,.0f} lines/sec ({:.2f}x)'.format(
+            num_lines / block_time, line_time / block_time))
+
+
+# ---------------------------------------------------------------------
+# Driver Function for BENCHMARKING IMPORT TIME
+# ---------------------------------------------------------------------
+
+def benchmark_import_time(modules=('run', 'src.m_stat', 'src.etl'),
+                          repeat=5):
+    """
+    Measures how long each module takes to import in a fresh interpreter,
+    which is what every short run.py invocation pays before doing any work
+    :param modules: Modules to import, relative to the project root
+    :param repeat: Number of fresh interpreters per module, keeping the best
+    """
+    code = ('import sys, time; sys.path.insert(0, "src"); '
+            't = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - t)')
+
+    for module in modules:
+        best = min(
+            float(subprocess.run([sys.executable, '-c', code.format(module)],
+                                 capture_output=True, check=True, text=True)
+                  .stdout)
+            for _ in range(repeat)
+        )
+        print('import {:<20} {:>8.1f} ms'.format(module, best * 1000))
+
+
+# ---------------------------------------------------------------------
+# Driver Function for BENCHMARKING THE XML PARSERS
+# ---------------------------------------------------------------------
+
+def benchmark_xml_parsers(data_dir='data/',
+                          fps=('enwiki-20200201-pages-meta-history13.xml-' +
+                               'p5136923p5137305',),
+                          parser_types=(0, 1), repeat=3):
+    """
+    Compares the throughput and peak memory of converting XML files to the
+    light dump with each parser. Every run is in a fresh interpreter so its
+    peak RSS is its own, and converts into a scratch directory so the light
+    dumps made by process_data() are left alone
+    :param data_dir: Directory for data
+    :param fps: File paths of unzipped XML files
+    :param parser_types: Parsers to compare (see unzip_to_txt())
+    :param repeat: Number of runs for each parser, keeping the best
+    """
+    code = ('import sys, time, resource; sys.path.insert(0, "src"); '
+            'from etl import unzip_to_txt; t = time.perf_counter(); '
+            'unzip_to_txt(data_dir={!r}, fp_unzip={!r}, tags=set(), '
+            'out_format=0, parser_type={}); '
+            'print(time.perf_counter() - t, '
+            'resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)')
+
+    scratch_dir = tempfile.mkdtemp(prefix='benchmark-') + '/'
+    os.makedirs(scratch_dir + 'temp/')
+    os.makedirs(scratch_dir + 'out/')
+    try:
+        for fp in fps:
+            fp_xml = '{}temp/{}'.format(data_dir, fp)
+            os.symlink(os.path.abspath(fp_xml), scratch_dir + 'temp/' + fp)
+            size = os.path.getsize(fp_xml) / 1e6
+            fp_txt = scratch_dir + 'out/' + get_xml_light_dump_name(fp)
+            print('Converting {} ({:.1f} MB)'.format(fp, size))
+            outputs, base_time = {}, None
+            for parser_type in parser_types:
+                runs = []
+                for _ in range(repeat):
+                    out = subprocess.run(
+                        [sys.executable, '-c',
+                         code.format(scratch_dir, fp, parser_type)],
+                        capture_output=True, check=True, text=True
+                    ).stdout.split('\n')[-2].split()
+                    runs.append((float(out[0]), int(out[1])))
+                best = min(run[0] for run in runs)
+                peak_rss = max(run[1] for run in runs) / 1024
+                base_time = base_time or best
+                with open(fp_txt, 'rb') as fh:
+                    outputs[parser_type] = fh.read()
+                print('parser_type {}: {:>7.1f} MB/s ({:.2f}x)  '
+                      'peak RSS {:>7.1f} MB'.format(
+                          parser_type, size / best, base_time / best,
+                          peak_rss))
+            if len(set(outputs.values())) > 1:
+                print('Parsers disagree on', fp)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+
+# ---------------------------------------------------------------------
+# Driver Function for LOAD TESTING THE M-STATISTIC SERVICE
+# ---------------------------------------------------------------------
+
+def get_load_test_queries(data_dir, num_requests):
+    """
+    Makes a mix of queries against every endpoint of the service
+    :param data_dir: Directory for data
+    :param num_requests: Number of queries
+    :return: List of (endpoint, path)
+    """
+    import numpy as np
+    from serve import MStatIndex
+
+    index = MStatIndex(data_dir)
+    articles = [fp.split('overtime-')[-1][:-len('.csv')] for fp in
+                glob.glob('{}out_m_stat/overtime-*.csv'.format(data_dir))]
+    m_stats = np.asarray(index.m_sorted)
+    if not len(index):
+        raise ValueError('No M-Statistics to query in ' + data_dir)
+
+    queries = []
+    for i in range(num_requests):
+        row = random.randrange(len(index))
+        endpoint = ('title', 'id', 'range', 'top', 'evolution')[i % 5]
+        if endpoint == 'title':
+            params = {'title': index.get_title(row)}
+        elif endpoint == 'id':
+            params = {'id': int(index.ids[row])}
+        elif endpoint == 'range':
+            low, high = sorted(random.choices(m_stats, k=2))
+            params = {'min': int(low), 'max': int(high), 'limit': 20}
+        elif endpoint == 'top':
+            params = {'n': random.choice((10, 50, 100))}
+        elif articles:
+            params = {'article': random.choice(articles)}
+        else:
+            continue
+        queries.append((endpoint, '/{}?{}'.format(endpoint,
+                                                  urlencode(params))))
+    return queries
+
+
+def wait_for_port(host, port, timeout=60):
+    """
+    Waits until a server accepts connections
+    :param host: Host of the server
+    :param port: Port of the server
+    :param timeout: Seconds to wait
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def benchmark_serve(data_dir='data/', host='127.0.0.1', port=8181,
+                    num_requests=5000, concurrency=8):
+    """
+    Starts a local instance of the M-Statistic service and load tests it,
+    reporting p50/p99 latency for each endpoint and the overall QPS
+    :param data_dir: Directory for data
+    :param host: Host for the service
+    :param port: Port for the service
+    :param num_requests: Number of requests to send
+    :param concurrency: Number of clients sending requests at once
+    """
+    import numpy as np
+    from serve import serve
+
+    # Builds the index once here, so the server only has to load it
+    queries = get_load_test_queries(data_dir, num_requests)
+    server = Process(target=serve, daemon=True,
+                     kwargs={'data_dir': data_dir, 'host': host,
+                             'port': port, 'quiet': 1})
+    server.start()
+    try:
+        wait_for_port(host, port)
+        latencies = {}
+        errors = []
+
+        def client(client_queries):
+            conn = HTTPConnection(host, port)
+            for endpoint, path in client_queries:
+                start = time.perf_counter()
+                try:
+                    conn.request('GET', path)
+                    res = conn.getresponse()
+                    res.read()
+                except Exception as e:
+                    # Counted like any other failed request, on a new
+                    # connection for the next one
+                    errors.append('{} ({!r})'.format(path, e))
+                    conn.close()
+                    conn = HTTPConnection(host, port)
+                    continue
+                latencies.setdefault(endpoint, []).append(
+                    time.perf_counter() - start)
+                if res.status != 200:
+                    errors.append('{} ({})'.format(path, res.status))
+            conn.close()
+
+        clients = [threading.Thread(target=client,
+                                    args=(queries[i::concurrency],))
+                   for i in range(concurrency)]
+        start = time.perf_counter()
+        for curr_client in clients:
+            curr_client.start()
+        for curr_client in clients:
+            curr_client.join()
+        total_time = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.join()
+
+    if errors:
+        raise RuntimeError('{} of {} requests failed, i.e. {}'.format(
+            len(errors), len(queries), errors[0]))
+    print('{} requests from {} clients in {:.2f} s: {:,.0f} QPS'.format(
+        len(queries), concurrency, total_time, len(queries) / total_time))
+    for endpoint, times in sorted(latencies.items()):
+        p50, p99 = np.percentile(times, [50, 99]) * 1000
+        print('{:<10} {:>6} requests  p50 {:>7.2f} ms  p99 {:>7.2f} ms'
+              .format(endpoint, len(times), p50, p99))
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for Checkpointing Long Runs
+# ---------------------------------------------------------------------
+
+def get_checkpoint_fp(fp_out):
+    """
+    Gets the checkpoint file path for an output file
+    :param fp_out: File path of the output being checkpointed
+    :return: File path of the checkpoint
+    """
+    return fp_out + '.ckpt'
+
+
+def hash_checkpoint_params(params):
+    """
+    Hashes the params that change a run's output, so a checkpoint is only
+    ever resumed by a run that writes the same output
+    :param params: Dictionary of the params
+    :return: Hash of the params
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=sorted)
+                          .encode('utf-8')).hexdigest()
+
+
+def write_checkpoint(fp_ckpt, state):
+    """
+    Atomically writes a checkpoint, so a crash mid-write never leaves a
+    partial checkpoint behind
+    :param fp_ckpt: File path of the checkpoint
+    :param state: Dictionary of the state to save
+    """
+    fp_tmp = fp_ckpt + '.tmp'
+    with open(fp_tmp, 'w') as fh:
+        json.dump(state, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(fp_tmp, fp_ckpt)
+
+
+def load_checkpoint(fp_ckpt, params_hash=None):
+    """
+    Loads a checkpoint if one exists
+    :param fp_ckpt: File path of the checkpoint
+    :param params_hash: Hash of the params of the run resuming, from
+                        hash_checkpoint_params()
+    :return: Dictionary of the saved state or None if there is no checkpoint
+             or it was made with other params
+    """
+    if not os.path.exists(fp_ckpt):
+        return None
+    with open(fp_ckpt) as fh:
+        state = json.load(fh)
+    if state.get('params') != params_hash:
+        print('{} was made with other params. Starting over'.format(fp_ckpt))
+        return None
+    return state
+
+
+def remove_checkpoint(fp_ckpt):
+    """
+    Removes the checkpoint of a run that starts over, so a later resume
+    never picks up a checkpoint of older output
+    :param fp_ckpt: File path of the checkpoint
+    """
+    if os.path.exists(fp_ckpt):
+        os.remove(fp_ckpt)
+
+
+def truncate_file(fp, size):
+    """
+    Truncates a file to the size recorded in the last consistent checkpoint
+    :param fp: File path
+    :param size: Size in bytes to truncate to
+    """
+    with open(fp, 'r+b') as fh:
+        fh.truncate(size)
@@ -0,0 +1,105 @@
+import os
+
+# Editor ids are stored as int32 by downstream analytics
+MAX_EDITOR_ID = 2 ** 31 - 1
+
+
+# ---------------------------------------------------------------------
+# Global Editor Dictionary Shared Across Pages and Files
+# ---------------------------------------------------------------------
+
+class EditorIds:
+    """
+    Interns editor names/IP addresses to stable integer ids
+    The same dictionary is used by conversion and scoring alike so that the
+    hot loops work on ints and every editor string is stored just once.
+    It is persisted as a text file with one editor per line, where the line
+    number is the editor's id, and only ever appended to
+    """
+
+    def __init__(self, fp=None):
+        """
+        :param fp: File path of the persisted dictionary (None to keep it
+                   in memory only)
+        """
+        self.fp = fp
+        # Maps editor names (and raw usernames with spaces) to their id
+        self.ids = {}
+        # Maps each id back to its light dump editor name
+        self.names = []
+        # Maps utf-8 encoded editors read straight from light dumps to their
+        # id, so each one is only ever decoded once
+        self.byte_ids = {}
+        self.num_saved = 0
+
+        if fp and os.path.exists(fp):
+            with open(fp, encoding='utf-8') as fh:
+                for name in fh:
+                    self.ids[name[:-1]] = len(self.names)
+                    self.names.append(name[:-1])
+            self.num_saved = len(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_id(self, editor):
+        """
+        Gets the id of an editor, adding it to the dictionary if new
+        Raw usernames are cached as they are, so the space replacement is
+        only ever done once per editor
+        :param editor: Username/IP address (None for deleted editors)
+        :return: Editor id
+        """
+        try:
+            return self.ids[editor]
+        except KeyError:
+            pass
+
+        # Any spaces in usernames are replaced with underscores
+        name = str(editor).replace(' ', '_')
+        editor_id = self.ids.get(name)
+        if editor_id is None:
+            editor_id = len(self.names)
+            if editor_id > MAX_EDITOR_ID:
+                raise OverflowError('Too many editors for int32 ids')
+            self.names.append(name)
+            self.ids[name] = editor_id
+        self.ids[editor] = editor_id
+        return editor_id
+
+    def get_ids_from_bytes(self, editors):
+        """
+        Gets the ids of editors read from the light dump as bytes, adding
+        new editors in order of appearance
+        :param editors: utf-8 encoded editor names
+        :return: List of editor ids
+        """
+        byte_ids = self.byte_ids
+        for editor in dict.fromkeys(editors):
+            if editor not in byte_ids:
+                byte_ids[editor] = self.get_id(editor.decode('utf-8'))
+        return list(map(byte_ids.__getitem__, editors))
+
+    def save(self):
+        """
+        Appends the editors added since the last save to the persisted file
+        """
+        if not self.fp or self.num_saved == len(self.names):
+            return
+        out_dir = os.path.dirname(self.fp)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(self.fp, 'a', encoding='utf-8') as fh:
+            for name in self.names[self.num_saved:]:
+                fh.write(name + '\n')
+        self.num_saved = len(self.names)
+
+
+def get_editor_ids_fp(data_dir='data/'):
+    """
+    Gets the default location of the persisted editor dictionary, which
+    lives alongside the M-Statistic outputs
+    :param data_dir: Directory for data
+    :return: File path of the editor dictionary
+    """
+    return '{}out_m_stat/editor-ids.txt'.format(data_dir)
@@ -1,11 +1,17 @@
-from urllib.request import urlretrieve
 from zipfile import ZipFile, BadZipfile
 from lxml import etree
 from copy import deepcopy
-from py7zr import unpack_7zarchive
 import shutil
 import os
-import pandas as pd
+import re
+from editors import EditorIds, get_editor_ids_fp
+from light_io import LightDumpWriter, get_article_light_dump_name,\
+    get_xml_light_dump_name, open_light_dump
+from checkpoint import get_checkpoint_fp, hash_checkpoint_params,\
+    load_checkpoint, remove_checkpoint, truncate_file, write_checkpoint
+
+# pandas, py7zr and urllib are slow to import and only needed for the csv
+# format, .7z files and downloads, so they are imported where used
 
 # Paths are as follows
 # i.e. Page: page_id, page_title
@@ -23,6 +29,7 @@ xpath_dict = {'page': 'ns:page',
               'model': 'ns:model',
               'format': 'ns:format',
               'edit': 'ns:text',
+              'sha1': 'ns:sha1',
               'comment': 'ns:comment',
               'contributor': 'ns:contributor',
               'username': 'ns:username',
@@ -36,6 +43,10 @@ rev_level_tags = {'rev_id', 'parent_id', 'timestamp', 'comment', 'model',
 contr_level_tags = {'username', 'user_id', 'user_ip'}
 
 nsmap = {'ns': 'http://www.mediawiki.org/xml/export-0.10/'}
+# Tags as seen by iterparse
+page_tag = '{{{}}}page'.format(nsmap['ns'])
+revision_tag = '{{{}}}revision'.format(nsmap['ns'])
+page_ns_tag = '{{{}}}ns'.format(nsmap['ns'])
 
 
 # ---------------------------------------------------------------------
@@ -43,7 +54,9 @@ nsmap = {'ns': 'http://www.mediawiki.org/xml/export-0.10/'}
 # ---------------------------------------------------------------------
 
 def context_to_txt(context, fp_txt, out_dir, tags, out_format,
-                   page_chunk=1):
+                   page_chunk=1, page_handler=None, editor_ids=None, fh=None,
+                   skip_pages=0, checkpoint_every=0, prune=0,
+                   params_hash=None):
     """
     Converts the XML Tree context to some text format
     Either csv or light format
@@ -53,6 +66,18 @@ def context_to_txt(context, fp_txt, out_dir, tags, out_format,
     :param tags: Tags used for csv format
     :param out_format: Format flag (0 for light_format, otherwise csv)
     :param page_chunk: Number of pages per chunk
+    :param page_handler: Optional callback given each page's title, revision
+                         order and editor order (light format only)
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param fh: Light dump writer (None to skip writing the light dump)
+    :param skip_pages: Number of pages already converted by a previous run
+    :param checkpoint_every: Number of pages between checkpoints of the
+                             output (0 for no checkpoints)
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts (light format only)
+    :param params_hash: Hash of the params of the output, kept with its
+                        checkpoints
+    :return: Number of pages converted
     """
 
     if out_format == 0:
@@ -64,38 +89,72 @@ def context_to_txt(context, fp_txt, out_dir, tags, out_format,
     tree = etree.ElementTree()
     root = etree.Element("wikimedia")
 
-    page_num = 1
+    page_num = 0
+    fp_ckpt = get_checkpoint_fp(out_dir + fp_txt)
 
     # loop through the large XML tree (streaming)
     for event, elem in context:
-        # After a given number of pages, write the tree to the XML file
-        # and reset the tree / create a new file.
-        if page_num % page_chunk == 0:
-            tree, root = write_tree_to_txt(
-                tree=tree, root=root, page_num=page_num, fp_txt=fp_txt,
-                out_dir=out_dir, tags=tags, light_format=light_format
-            )
-
-        # add the 'page' element to the small tree
-        root.append(deepcopy(elem))
         page_num += 1
 
+        # add the 'page' element to the small tree, unless it was already
+        # converted before resuming
+        if page_num > skip_pages:
+            root.append(deepcopy(elem))
+
         # release unneeded XML from memory
         elem.clear()
         while elem.getprevious() is not None:
             del elem.getparent()[0]
 
+        # After a given number of pages, write the tree to the XML file
+        # and reset the tree / create a new file.
+        if page_num % page_chunk == 0 and len(root):
+            tree, root = write_tree_to_txt(
+                tree=tree, root=root, page_num=page_num, fp_txt=fp_txt,
+                out_dir=out_dir, tags=tags, light_format=light_format,
+                page_handler=page_handler, editor_ids=editor_ids, fh=fh,
+                prune=prune
+            )
+
+            # Everything up to page_num is written, so save a checkpoint
+            # lxml reads ahead of the pages it hands over, so no input
+            # offset is kept and resuming skips pages by count instead
+            if (checkpoint_every and (fh is not None or not light_format)
+                    and not page_num % checkpoint_every):
+                if light_format:
+                    editor_ids.save()
+                write_checkpoint(fp_ckpt, {
+                    'params': params_hash,
+                    'pages': page_num,
+                    'light_dump': fh.checkpoint() if light_format else None,
+                    'csv_offset': None if light_format else
+                    get_file_size(out_dir + fp_txt),
+                    'done': 0
+                })
+
     # Edge case for extra pages in memory
-    if page_num % page_chunk:
+    if len(root):
         write_tree_to_txt(
                 tree=tree, root=root, page_num=page_num, fp_txt=fp_txt,
-                out_dir=out_dir, tags=tags, light_format=light_format
+                out_dir=out_dir, tags=tags, light_format=light_format,
+                page_handler=page_handler, editor_ids=editor_ids, fh=fh,
+                prune=prune
                 )
     del context
+    return page_num
+
+
+def get_file_size(fp):
+    """
+    :param fp: File path
+    :return: Size of the file in bytes (0 if it does not exist yet)
+    """
+    return os.path.getsize(fp) if os.path.exists(fp) else 0
 
 
 def write_tree_to_txt(tree, root, page_num, fp_txt, out_dir, tags,
-                      light_format=True):
+                      light_format=True, page_handler=None, editor_ids=None,
+                      fh=None, prune=0):
     """
     Writes tree to csv file
     :param tree: Etree
@@ -105,12 +164,19 @@ def write_tree_to_txt(tree, root, page_num, fp_txt, out_dir, tags,
     :param out_dir: Data directory for output
     :param tags: Tags used for output
     :param light_format: Whether or not to output light format
+    :param page_handler: Optional callback for each converted page
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param fh: Light dump writer (None to skip writing the light dump)
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts
     :return:
     """
     print('Begin conversion just up to {}'.format(page_num))
     # If desired output is in light dump format
     if light_format:
-        convert_tree_light_format(root=root, out_dir=out_dir, fp_txt=fp_txt)
+        convert_tree_light_format(root=root, fh=fh,
+                                  page_handler=page_handler,
+                                  editor_ids=editor_ids, prune=prune)
         print('converted up to {}'.format(page_num))
         return etree.ElementTree(), etree.Element("wikimedia")
 
@@ -142,33 +208,131 @@ def get_tag_if_exists(parent, tag):
         return res
 
 
-def convert_tree_light_format(root, out_dir, fp_txt):
+def convert_page_light_format(page_title, time_mapper, editor_ids, fh=None,
+                              page_handler=None):
     """
-    Converts from the XML tree to light formatted data
+    Converts the revisions of a single page to light formatted data
     Example formatting:
         Anarchism
         ^^^_2019-05-17T01:24:12Z 0 493 JJMC89
 
         [Page title]
         ^^^[datetime] [flag for revert] [edit number] [editor name/IP address]
+    :param page_title: Title of the page
+    :param time_mapper: Maps every time to the (edit, editor id)
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param fh: File handle for the light dump output (None to skip writing)
+    :param page_handler: Optional callback given the page title, revision
+                         order and editor id order in the same descending order
+                         as the light dump (i.e. latest to earliest)
+    """
+    # Rev_mapper keeps track of each revision's text because that's
+    # how each revert is tracked
+    # (WHICH IS SUPER FUCKING SPACE INEFFICIENT. BUT IDK, DOES ANYONE HAVE
+    # A BETTER FUCKING IDEA. FUCKING CS NIGHTMARE HERE. WIKIMEDIA NEEDS TO
+    # FIX THIS SHIT)
+    rev_mapper, rev_count, lines, rev_order, editor_order =\
+        {}, 1, [], [], []
+    # Iterates across each edit in chronological order
+    for time in sorted(time_mapper.keys()):
+        curr_rev, editor_id = time_mapper[time]
+        # Checks if edit was seen before and thus it was a revert
+        if curr_rev not in rev_mapper:
+            # Adds new edit to dictionary that maps each edit's text
+            # to their revision ID number
+            rev_mapper[curr_rev] = rev_count
+            rev_count += 1
+            revert_flag = 0
+        else:
+            revert_flag = 1
+        curr_rev = rev_mapper[curr_rev]
+        if fh is not None:
+            curr_line = '^^^_{} {} {} {}\n'.format(
+                time, revert_flag, curr_rev, editor_ids.names[editor_id]
+            )
+            lines.append(curr_line)
+        if page_handler is not None:
+            rev_order.append(curr_rev)
+            editor_order.append(editor_id)
+
+    # Reverses for descending order
+    if fh is not None:
+        fh.write(page_title + '\n')
+        fh.writelines(lines[::-1])
+    if page_handler is not None:
+        page_handler(page_title, rev_order[::-1], editor_order[::-1])
+    del lines
+
+
+def can_prune_page(time_mapper, sha1_mapper):
+    """
+    Checks whether a page has no reverts, and so an M-Statistic of 0, from
+    the sha1s of its revisions. Reverts are edits with the same text as an
+    earlier edit, which can't happen when every sha1 is different
+    :param time_mapper: Maps every time to the (edit, editor id)
+    :param sha1_mapper: Maps every time to the sha1 of the edit
+    :return: Whether or not the page can be pruned
+    """
+    # Deleted and empty edits have no text to compare, so are never pruned
+    if any(edit is None for edit, _ in time_mapper.values()):
+        return False
+    sha1s = set(sha1_mapper.values())
+    return None not in sha1s and len(sha1s) == len(sha1_mapper)
+
+
+def convert_pruned_page_light_format(page_title, time_mapper, fh=None,
+                                     page_handler=None):
+    """
+    Converts a page without reverts to a summary of its edits in place of its
+    revisions
+    Example formatting:
+        Anarchism
+        ^^^= 493 201
+
+        [Page title]
+        ^^^= [number of edits] [number of editors]
+    :param page_title: Title of the page
+    :param time_mapper: Maps every time to the (edit, editor id)
+    :param fh: File handle for the light dump output (None to skip writing)
+    :param page_handler: Optional callback given the page title, revision
+                         order and editor id order (latest to earliest)
+    """
+    editor_order = [time_mapper[time][1] for time in
+                    sorted(time_mapper.keys(), reverse=True)]
+    if fh is not None:
+        fh.write('{}\n^^^= {} {}\n'.format(page_title, len(editor_order),
+                                            len(set(editor_order))))
+    if page_handler is not None:
+        # Without reverts every edit is a new revision
+        page_handler(page_title, list(range(len(editor_order), 0, -1)),
+                     editor_order)
+
+
+def convert_tree_light_format(root, fh=None, page_handler=None,
+                              editor_ids=None, prune=0):
+    """
+    Converts from the XML tree to light formatted data
+    See convert_page_light_format() for the formatting of each page
     :param root: Root of tree
-    :param out_dir: Output directory
-    :param fp_txt: Filepath for output
+    :param fh: Light dump writer (None to skip writing the light dump)
+    :param page_handler: Optional callback for each converted page
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts (see convert_pruned_page_light_format())
     """
-    # File Handle
-    fh = open(out_dir + fp_txt, 'a')
+    if editor_ids is None:
+        editor_ids = EditorIds()
     # Only necessary columns
     cols = ['timestamp', 'edit', 'username']
 
     # Iterates through every page under the current root
     for page_el in root.iterfind(xpath_dict['page'], namespaces=nsmap):
         page_title = get_tag_if_exists(page_el, 'page_title')
-        fh.write(page_title + '\n')
 
         # Keeps of edits by their time
         # Tragically ugly but necessary because raw dumps are not in
         # chronological order
-        time_mapper = {}
+        time_mapper, sha1_mapper = {}, {}
         for rev_el in page_el.iterfind(xpath_dict['revision'],
                                        namespaces=nsmap):
             # Grabs necessary information: time, edit text, username/ip
@@ -178,40 +342,17 @@ def convert_tree_light_format(root, out_dir, fp_txt):
             user = get_tag_if_exists(contr_el, cols[2])
             if not user:
                 user = get_tag_if_exists(contr_el, 'user_ip')
-            if user:
-                # Any spaces in usernames are replaced with underscores
-                user = user.replace(' ', '_')
-            curr_line = (curr_rev, user)
-            # Maps every time to the (edit, username/IP address)
-            time_mapper[timestamp] = curr_line
-
-        # Rev_mapper keeps track of each revision's text because that's
-        # how each revert is tracked
-        # (WHICH IS SUPER FUCKING SPACE INEFFICIENT. BUT IDK, DOES ANYONE HAVE
-        # A BETTER FUCKING IDEA. FUCKING CS NIGHTMARE HERE. WIKIMEDIA NEEDS TO
-        # FIX THIS SHIT)
-        rev_mapper, rev_count, lines =\
-            {}, 1, []
-        # Iterates across each edit in chronological order
-        for time in sorted(time_mapper.keys()):
-            curr_rev, user = time_mapper[time][0], time_mapper[time][1]
-            timestamp = '^^^_' + time
-            # Checks if edit was seen before and thus it was a revert
-            if curr_rev not in rev_mapper:
-                # Adds new edit to dictionary that maps each edit's text
-                # to their revision ID number
-                rev_mapper[curr_rev] = rev_count
-                rev_count += 1
-                revert_flag = 0
-            else:
-                revert_flag = 1
-            curr_rev = rev_mapper[curr_rev]
-            curr_line = '{} {} {} {}\n'.format(timestamp, revert_flag,
-                                               curr_rev, user)
-            lines.append(curr_line)
-        # Reverses for descending order
-        fh.writelines(lines[::-1])
-        del lines
+            # Maps every time to the (edit, editor id)
+            time_mapper[timestamp] = (curr_rev, editor_ids.get_id(user))
+            if prune:
+                sha1_mapper[timestamp] = get_tag_if_exists(rev_el, 'sha1')
+
+        if prune and can_prune_page(time_mapper, sha1_mapper):
+            convert_pruned_page_light_format(page_title, time_mapper, fh=fh,
+                                             page_handler=page_handler)
+            continue
+        convert_page_light_format(page_title, time_mapper, editor_ids, fh=fh,
+                                  page_handler=page_handler)
 
 
 def convert_tree_to_df(root, tags):
@@ -221,6 +362,8 @@ def convert_tree_to_df(root, tags):
     :param tags: Desired tags
     :return: Dataframe
     """
+    import pandas as pd
+
     # Initializes tags for different levels within the xml format
     curr_page_level_tags = list(tags.intersection(page_level_tags))
     curr_rev_level_tags = list(tags.intersection(rev_level_tags))
@@ -255,7 +398,89 @@ def convert_tree_to_df(root, tags):
     return df
 
 
-def unzip_to_txt(data_dir, fp_unzip, tags, out_format):
+def make_page_filter(namespaces=None, title_include=None, title_exclude=None,
+                     title_list_fp=None):
+    """
+    Makes a filter for which pages to convert from the page header
+    :param namespaces: Namespaces to keep, i.e. [0] for just articles
+                       (None to keep all)
+    :param title_include: Regex patterns, keeping only titles that match at
+                          least one (None to keep all)
+    :param title_exclude: Regex patterns, dropping titles that match any
+    :param title_list_fp: File path of a list of titles to keep, one per
+                          line (None to keep all)
+    :return: Function of the page title and namespace that is True for pages
+             to keep, or None when there is nothing to filter
+    """
+    if not (namespaces or title_include or title_exclude or title_list_fp):
+        return None
+    namespaces = set(map(int, namespaces)) if namespaces else None
+    include_re = re.compile('|'.join(title_include)) \
+        if title_include else None
+    exclude_re = re.compile('|'.join(title_exclude)) \
+        if title_exclude else None
+    titles = None
+    if title_list_fp:
+        with open(title_list_fp, encoding='utf-8') as fh:
+            # Titles are in the dump with spaces rather than underscores
+            titles = {line.strip().replace('_', ' ') for line in fh
+                      if line.strip()}
+
+    def page_filter(title, namespace):
+        if namespaces is not None and namespace not in namespaces:
+            return False
+        if titles is not None and title not in titles:
+            return False
+        if include_re and not include_re.search(title):
+            return False
+        return not (exclude_re and exclude_re.search(title))
+    return page_filter
+
+
+def filter_pages(context, page_filter):
+    """
+    Filters the pages of an iterparse context that also reports the end of
+    every namespace and revision element. Each page is checked as soon as
+    its header is parsed, and the revisions of pages that are filtered out
+    are cleared as they come instead of being kept until the page ends
+    :param context: XML iterable context of page, ns and revision elements
+    :param page_filter: Filter from make_page_filter()
+    :return: Generator of (event, page element) for the pages to keep
+    """
+    keep, num_filtered = None, 0
+    for event, elem in context:
+        if elem.tag == page_ns_tag:
+            page_el = elem.getparent()
+            keep = page_filter(get_tag_if_exists(page_el, 'page_title'),
+                               int(elem.text))
+        elif elem.tag == revision_tag:
+            # Pages without a namespace are checked at their first revision
+            if keep is None:
+                page_el = elem.getparent()
+                keep = page_filter(get_tag_if_exists(page_el, 'page_title'),
+                                   None)
+            if not keep:
+                elem.clear()
+                elem.getparent().remove(elem)
+        else:
+            if keep is None:
+                keep = page_filter(get_tag_if_exists(elem, 'page_title'),
+                                   None)
+            if keep:
+                yield event, elem
+            else:
+                num_filtered += 1
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            keep = None
+    print('Filtered out {} pages'.format(num_filtered))
+
+
+def unzip_to_txt(data_dir, fp_unzip, tags, out_format, page_handler=None,
+                 light_dump=True, editor_ids=None, compression=None,
+                 checkpoint_every=0, resume=0, prune=0, page_filter=None,
+                 parser_type=0, filter_params=None):
     """
     Unzips file to desired output format
     Currently supports only csv or light dump format
@@ -263,20 +488,104 @@ def unzip_to_txt(data_dir, fp_unzip, tags, out_format):
     :param fp_unzip: File path of unzipped file
     :param tags: Desired tags for csv format
     :param out_format: Output format (0 for light dump, otherwise csv)
+    :param page_handler: Optional callback for each converted page
+    :param light_dump: Whether or not to write the light dump text file
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param compression: Compression for the light dump ('gzip', 'zstd' or
+                        None for plain text)
+    :param checkpoint_every: Number of pages between checkpoints of the
+                             output (0 for no checkpoints)
+    :param resume: Whether or not to resume from the last checkpoint
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts
+    :param page_filter: Filter of pages to convert from make_page_filter()
+                        (None to convert every page)
+    :param parser_type: XML parser for the light dump format (0 for
+                        iterparse, 1 for the text discarding expat parser
+                        in light_parser.py)
+    :param filter_params: Params page_filter was made from, which are kept
+                          with the checkpoints like the other params
     """
     temp_dir = '{}temp/'.format(data_dir)
     out_dir = '{}out/'.format(data_dir)
-    fp_txt = 'light-dump-{}.txt'.format(fp_unzip.replace('.', '-'))
-    context = etree.iterparse(temp_dir + fp_unzip,
-                              tag='{http://www.mediawiki.org/' +\
-                                  'xml/export-0.10/}page',
-                              encoding='utf-8', huge_tree=True)
+    fp_txt = get_xml_light_dump_name(fp_unzip)
+    if editor_ids is None:
+        editor_ids = EditorIds()
+
+    # Picks up from the last consistent checkpoint of the light dump
+    # Only a checkpoint of the same output can be resumed
+    params_hash = hash_checkpoint_params({
+        'tags': tags if out_format else None, 'out_format': out_format,
+        'light_dump': light_dump, 'compression': compression,
+        'prune': prune, 'parser_type': parser_type,
+        'filters': filter_params if page_filter else None
+    })
+    fp_ckpt = get_checkpoint_fp(out_dir + fp_txt)
+    ckpt = load_checkpoint(fp_ckpt, params_hash) if resume else None
+    if ckpt and ckpt['done']:
+        print('Already converted {}. Skipping'.format(fp_unzip))
+        return
+    if ckpt:
+        print('Resuming {} after page {}'.format(fp_unzip, ckpt['pages']))
+    else:
+        remove_checkpoint(fp_ckpt)
+    # The csv is appended to page by page, so it has to start empty or from
+    # where its checkpoint left off
+    if out_format != 0:
+        if ckpt:
+            truncate_file(out_dir + fp_txt, ckpt['csv_offset'])
+        elif os.path.exists(out_dir + fp_txt):
+            os.remove(out_dir + fp_txt)
+
+    xml_fh = open(temp_dir + fp_unzip, 'rb')
+    # The expat parser reads the XML file itself, without a context
+    context = None
+    if parser_type != 1 or out_format != 0:
+        if page_filter is None:
+            context = etree.iterparse(xml_fh, tag=page_tag,
+                                      encoding='utf-8', huge_tree=True)
+        else:
+            context = filter_pages(
+                etree.iterparse(xml_fh,
+                                tag=(page_tag, page_ns_tag, revision_tag),
+                                encoding='utf-8', huge_tree=True),
+                page_filter
+            )
+    # One buffered writer for the whole run
+    fh = None
+    if out_format == 0 and light_dump:
+        fh = LightDumpWriter(out_dir + fp_txt, compression=compression,
+                             resume=ckpt['light_dump'] if ckpt else None)
     print('Converting to txt')
-    context_to_txt(context=context, fp_txt=fp_txt, out_dir=out_dir,
-                   tags=tags, out_format=out_format)
+    if context is None:
+        from light_parser import stream_to_light_format
+        page_num = stream_to_light_format(
+            xml_fh=xml_fh, fp_txt=fp_txt, out_dir=out_dir,
+            editor_ids=editor_ids, fh=fh, page_handler=page_handler,
+            skip_pages=ckpt['pages'] if ckpt else 0,
+            checkpoint_every=checkpoint_every, prune=prune,
+            page_filter=page_filter, ckpt=ckpt, params_hash=params_hash
+        )
+    else:
+        page_num = context_to_txt(
+            context=context, fp_txt=fp_txt, out_dir=out_dir, tags=tags,
+            out_format=out_format, page_handler=page_handler,
+            editor_ids=editor_ids, fh=fh,
+            skip_pages=ckpt['pages'] if ckpt else 0,
+            checkpoint_every=checkpoint_every, prune=prune,
+            params_hash=params_hash
+        )
+    if fh is not None:
+        fh.close()
+    if checkpoint_every and (fh is not None or out_format != 0):
+        editor_ids.save()
+        write_checkpoint(fp_ckpt, {'params': params_hash, 'pages': page_num,
+                                   'light_dump': None, 'csv_offset': None,
+                                   'done': 1})
 
     # Delete etree
     del context
+    xml_fh.close()
     print('Done with ' + temp_dir + fp_unzip)
 
 
@@ -287,6 +596,8 @@ def get_files_from_url(url, raw_dir):
     :param raw_dir: Directory for raw data
     :return: Returns file path for created file
     """
+    from urllib.request import urlretrieve
+
     zip_fp = url.split('/')[-1]
     if not os.path.exists(raw_dir + zip_fp):
         urlretrieve(url, raw_dir + zip_fp)
@@ -295,6 +606,26 @@ def get_files_from_url(url, raw_dir):
     return zip_fp
 
 
+def get_archive_names(fp_zip):
+    """
+    Gets the names of the top level files and directories in an archive
+    Supports .7z and .zip, and treats any other file as already unpacked
+    :param fp_zip: File path of zipped file
+    :return: List of names in the order they are stored
+    """
+    if fp_zip.split('.')[-1] == '7z':
+        from py7zr import SevenZipFile
+        with SevenZipFile(fp_zip) as archive:
+            names = archive.getnames()
+    else:
+        try:
+            with ZipFile(fp_zip) as archive:
+                names = archive.namelist()
+        except BadZipfile:
+            names = [fp_zip.split('/')[-1]]
+    return list(dict.fromkeys(name.split('/')[0] for name in names))
+
+
 def unpack_zip(raw_dir, temp_dir, fp_zip):
     """
     Unpacks a zip file
@@ -306,6 +637,7 @@ def unpack_zip(raw_dir, temp_dir, fp_zip):
     """
     # Unzips the current file
     if fp_zip.split('.')[-1] == '7z':
+        from py7zr import unpack_7zarchive
         # Registers format to .7zip
         try:
             shutil.register_unpack_format('7zip', ['.7z'], unpack_7zarchive)
@@ -325,8 +657,12 @@ def unpack_zip(raw_dir, temp_dir, fp_zip):
 
     print('Unzipped', raw_dir + fp_zip, 'to', temp_dir)
 
-    fp_unzip = max([temp_dir + file for file in os.listdir(temp_dir)],
-                   key = os.path.getctime)
+    # Taken from the archive itself, as the newest file in temp_dir may be
+    # left over from another run or written by a concurrent stage
+    fp_unzips = get_archive_names(raw_dir + fp_zip)
+    fp_unzip = fp_unzips[0]
+    if len(fp_unzips) > 1:
+        print('Archive holds several files, using the first of', fp_unzips)
 
     print('Unzipped file path:', temp_dir + fp_unzip)
     return fp_unzip
@@ -435,7 +771,16 @@ def process_data(
             'enwiki-20200101-pages-meta-history1.xml-p1037p2031'
         ),
         tags=('page_title', 'rev_id', 'parent_id', 'username', 'user_ip'),
-        out_format=0
+        out_format=0,
+        compression=None,
+        checkpoint_every=0,
+        resume=0,
+        prune=0,
+        namespaces=None,
+        title_include=None,
+        title_exclude=None,
+        title_list_fp=None,
+        parser_type=0
 ):
     """
     Processes the XML file into more readable formats
@@ -444,6 +789,25 @@ def process_data(
     :param fps: List of file paths
     :param tags: XML tags to store for csv format
     :param out_format: Output format, 0 for light dump format, otherwise csv
+    :param compression: Compression for the light dump ('gzip', 'zstd' or
+                        None for plain text)
+    :param checkpoint_every: Number of pages between checkpoints of the
+                             output (0 for no checkpoints)
+    :param resume: Whether or not to resume each file from its last
+                   checkpoint instead of starting over
+    :param prune: Whether or not to write only the number of edits and
+                  editors of pages without reverts (light dump only), as
+                  their M-Statistic is always 0
+    :param namespaces: Namespaces of pages to keep, i.e. [0] for just
+                       articles (None to keep all)
+    :param title_include: Regex patterns, keeping only titles that match at
+                          least one (None to keep all)
+    :param title_exclude: Regex patterns, dropping titles that match any
+    :param title_list_fp: File path of a list of titles to keep, one per
+                          line (None to keep all)
+    :param parser_type: XML parser for the light dump format (0 for
+                        iterparse, 1 for the text discarding expat parser,
+                        which needs far less memory for long histories)
     """
 
     if not isinstance(tags, set):
@@ -454,10 +818,22 @@ def process_data(
                   "{'page_title', 'rev_id', 'parent_id', 'username'," +
                   "'user_ip'}. Try again")
 
+    # Editor ids are shared with the M-Statistic scoring
+    editor_ids = EditorIds(get_editor_ids_fp(data_dir))
+    page_filter = make_page_filter(namespaces, title_include, title_exclude,
+                                   title_list_fp)
+
     for fp_unzip in fps:
         print('Starting with {}'.format(fp_unzip))
         unzip_to_txt(data_dir=data_dir, fp_unzip=fp_unzip, tags=tags,
-                     out_format=out_format)
+                     out_format=out_format, editor_ids=editor_ids,
+                     compression=compression,
+                     checkpoint_every=checkpoint_every, resume=resume,
+                     prune=prune, page_filter=page_filter,
+                     parser_type=parser_type,
+                     filter_params=[namespaces, title_include, title_exclude,
+                                    title_list_fp])
+        editor_ids.save()
 
 
 # ---------------------------------------------------------------------
@@ -474,7 +850,8 @@ def extract_article(
     """
     Extracts a desired article from a list of light dump files
     :param data_dir: Directory for data
-    :param fps: List of light dump formatted files' paths
+    :param fps: List of light dump formatted files' paths (plain or
+                compressed)
     :param desired_articles: Desired article titles
     """
 
@@ -486,18 +863,14 @@ def extract_article(
     for fp in fps:
         curr_article_desired, curr_lines = None, []
         # Iterates through each line in the light dump file
-        for line in open(out_dir + fp):
+        for line in open_light_dump(out_dir + fp):
 
             # Passes through at the start of the next article
             if '^^^' != line[:3]:
                 # Writes article text to file
                 if curr_article_desired:
-                    desired_article_out_fp =\
-                        '{}light-dump-{}.txt'.format(
-                            out_dir,
-                            curr_article_desired.replace(' ', '-')
-                            .replace('_', '-')
-                        )
+                    desired_article_out_fp = out_dir +\
+                        get_article_light_dump_name(curr_article_desired)
                     with open(desired_article_out_fp, 'w+') as curr_fh:
                         for curr_line in curr_lines:
                             curr_fh.write(curr_line)
@@ -523,10 +896,8 @@ def extract_article(
 
     # Writes article text to file
     if curr_article_desired:
-        desired_article_out_fp = \
-            '{}light-dump-{}.txt'.format(
-                out_dir, curr_article_desired.replace(' ', '-')
-            )
+        desired_article_out_fp = out_dir +\
+            get_article_light_dump_name(curr_article_desired)
         with open(desired_article_out_fp, 'w+') as curr_fh:
             for curr_line in curr_lines:
                 curr_fh.write(curr_line)
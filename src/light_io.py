@@ -0,0 +1,287 @@
+import bisect
+import gzip
+import io
+import os
+
+# zstd is optional: in the standard library from Python 3.14 onwards and
+# available as the backports.zstd package before that
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+# File suffix for each supported compression codec
+compression_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Uncompressed size of each block written to the light dump
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for Light Dump File Paths
+# ---------------------------------------------------------------------
+
+def get_compression(fp):
+    """
+    Gets the compression codec of a light dump from its file path
+    :param fp: File path of the light dump
+    :return: Compression codec or None for plain text
+    """
+    for compression, suffix in compression_suffixes.items():
+        if fp.endswith(suffix):
+            return compression
+    return None
+
+
+def get_light_dump_name(fp):
+    """
+    Removes any compression suffix from a light dump file path
+    i.e. light-dump-Anarchism.txt.gz -> light-dump-Anarchism.txt
+    :param fp: File path of the light dump
+    :return: File path of the uncompressed light dump
+    """
+    compression = get_compression(fp)
+    if compression:
+        return fp[:-len(compression_suffixes[compression])]
+    return fp
+
+
+def get_xml_light_dump_name(fp_unzip):
+    """
+    Gets the light dump file name of an unzipped XML file
+    i.e. enwiki-20200201-pages-meta-history1.xml-p10p1036
+         -> light-dump-enwiki-20200201-pages-meta-history1-xml-p10p1036.txt
+    :param fp_unzip: File name of the unzipped XML file
+    :return: File name of its light dump, before any compression suffix
+    """
+    return 'light-dump-{}.txt'.format(fp_unzip.replace('.', '-'))
+
+
+def get_article_light_dump_name(title):
+    """
+    Gets the light dump file name of an article extracted on its own
+    i.e. Barack_Obama -> light-dump-Barack-Obama.txt
+    :param title: Title of the article
+    :return: File name of the article's light dump
+    """
+    return 'light-dump-{}.txt'.format(title.replace(' ', '-')
+                                      .replace('_', '-'))
+
+
+def resolve_light_dump(fp):
+    """
+    Finds the light dump on disk, whether or not it was compressed
+    :param fp: File path of the light dump, with or without suffix
+    :return: File path of the light dump on disk
+    """
+    if os.path.exists(fp):
+        return fp
+    for suffix in compression_suffixes.values():
+        if os.path.exists(fp + suffix):
+            return fp + suffix
+    return fp
+
+
+def remove_other_formats(fp, compression=None):
+    """
+    Removes the light dump and its block index in every format but one
+    :param fp: File path of the uncompressed light dump
+    :param compression: Compression codec of the format to keep
+    """
+    for other in [None] + list(compression_suffixes):
+        if other == compression:
+            continue
+        other_fp = fp + compression_suffixes.get(other, '')
+        for remove_fp in (other_fp, other_fp + '.idx'):
+            if os.path.exists(remove_fp):
+                print('Removing light dump in another format', remove_fp)
+                os.remove(remove_fp)
+
+
+def load_block_index(fp):
+    """
+    Loads the per-block index of a compressed light dump
+    Each line of the index holds the uncompressed and compressed offsets
+    of the start of a block
+    :param fp: File path of the compressed light dump
+    :return: Uncompressed offsets and compressed offsets of each block
+    """
+    uncompressed_offsets, compressed_offsets = [], []
+    if not os.path.exists(fp + '.idx'):
+        return [0], [0]
+    with open(fp + '.idx') as fh:
+        for line in fh:
+            line = line.split()
+            uncompressed_offsets.append(int(line[0]))
+            compressed_offsets.append(int(line[1]))
+    if not uncompressed_offsets:
+        return [0], [0]
+    return uncompressed_offsets, compressed_offsets
+
+
+def check_compression(compression):
+    """
+    Checks that the compression codec is supported and available
+    :param compression: Compression codec ('gzip', 'zstd' or None)
+    """
+    if compression and compression not in compression_suffixes:
+        raise ValueError('Unknown compression {}. Try one of {}'.format(
+            compression, list(compression_suffixes)))
+    if compression == 'zstd' and zstd is None:
+        raise ImportError('zstd compression needs Python 3.14 or the ' +
+                          'backports.zstd package')
+
+
+# ---------------------------------------------------------------------
+# Reading and Writing Light Dumps
+# ---------------------------------------------------------------------
+
+def open_light_dump(fp, offset=0, binary=False):
+    """
+    Opens a plain or compressed light dump for reading
+    Compressed light dumps are a series of independent gzip members/zstd
+    frames, so reading can start from any block listed in the index
+    :param fp: File path of the light dump, with or without suffix
+    :param offset: Uncompressed byte offset to start reading from
+    :param binary: Whether or not to return a binary file object
+    :return: File object
+    """
+    fp = resolve_light_dump(fp)
+    compression = get_compression(fp)
+    fh = open(fp, 'rb')
+    if not compression:
+        fh.seek(offset)
+    else:
+        check_compression(compression)
+        uncompressed_offsets, compressed_offsets = load_block_index(fp)
+        block = bisect.bisect_right(uncompressed_offsets, offset) - 1
+        fh.seek(compressed_offsets[block])
+        if compression == 'gzip':
+            fh = gzip.GzipFile(fileobj=fh, mode='rb')
+        else:
+            fh = zstd.ZstdFile(fh, mode='rb')
+        # Skips to the offset within the block
+        to_skip = offset - uncompressed_offsets[block]
+        while to_skip > 0:
+            to_skip -= len(fh.read(min(to_skip, BLOCK_SIZE)))
+    if binary:
+        return fh
+    return io.TextIOWrapper(fh, encoding='utf-8')
+
+
+class LightDumpWriter:
+    """
+    Buffered writer for light dump output
+    Keeps one file handle per run and writes in large blocks. When
+    compressed, each block is its own gzip member/zstd frame and is recorded
+    in a '.idx' index so the light dump stays seekable
+    """
+
+    def __init__(self, fp, compression=None, block_size=BLOCK_SIZE,
+                 resume=None):
+        """
+        :param fp: File path of the (uncompressed) light dump
+        :param compression: Compression codec ('gzip', 'zstd' or None)
+        :param block_size: Uncompressed size of each block
+        :param resume: State from checkpoint() to truncate back to and
+                       continue writing from (None to start over)
+        """
+        check_compression(compression)
+        self.compression = compression
+        self.fp = fp + compression_suffixes.get(compression, '')
+        self.block_size = block_size
+        self.lines, self.buffered = [], 0
+        # Uncompressed bytes and compressed blocks written so far
+        self.offset, self.blocks = 0, 0
+
+        if resume is None:
+            # Readers pick up any format on disk, so a light dump left over
+            # in another format must not outlive this one
+            remove_other_formats(fp, compression)
+            self.fh = open(self.fp, 'wb')
+            self.idx_fh = open(self.fp + '.idx', 'w') if compression else None
+            return
+
+        # Drops anything written after the checkpoint
+        self.fh = open(self.fp, 'r+b')
+        self.fh.truncate(resume['file_offset'])
+        self.fh.seek(resume['file_offset'])
+        self.offset, self.blocks = resume['offset'], resume['blocks']
+        self.idx_fh = None
+        if compression:
+            with open(self.fp + '.idx') as fh:
+                blocks = fh.readlines()[:resume['blocks']]
+            self.idx_fh = open(self.fp + '.idx', 'w')
+            self.idx_fh.writelines(blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, text):
+        """
+        Writes text to the buffer, flushing full blocks
+        :param text: Text to write
+        """
+        self.lines.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.block_size:
+            self.flush_block()
+
+    def writelines(self, lines):
+        """
+        Writes several lines to the buffer, flushing full blocks
+        :param lines: Lines to write
+        """
+        for line in lines:
+            self.lines.append(line)
+            self.buffered += len(line)
+        if self.buffered >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self):
+        """
+        Writes the buffered text as a single block
+        """
+        if not self.lines:
+            return
+        data = ''.join(self.lines).encode('utf-8')
+        self.lines, self.buffered = [], 0
+        if self.compression:
+            self.idx_fh.write('{} {}\n'.format(self.offset, self.fh.tell()))
+            self.blocks += 1
+            if self.compression == 'gzip':
+                data_out = gzip.compress(data)
+            else:
+                data_out = zstd.compress(data)
+            self.fh.write(data_out)
+        else:
+            self.fh.write(data)
+        self.offset += len(data)
+
+    def checkpoint(self):
+        """
+        Flushes everything written so far to disk
+        :return: State for resuming from this point
+        """
+        self.flush_block()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        if self.idx_fh:
+            self.idx_fh.flush()
+        return {'offset': self.offset, 'file_offset': self.fh.tell(),
+                'blocks': self.blocks}
+
+    def close(self):
+        """
+        Flushes the remaining text and closes the file handles
+        """
+        self.flush_block()
+        self.fh.close()
+        if self.idx_fh:
+            self.idx_fh.close()
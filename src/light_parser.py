@@ -0,0 +1,229 @@
+import hashlib
+from xml.parsers import expat
+from etl import can_prune_page, convert_page_light_format,\
+    convert_pruned_page_light_format
+from checkpoint import get_checkpoint_fp, write_checkpoint
+
+# Bytes of XML fed to the parser at a time
+FEED_SIZE = 1024 * 1024
+
+# Elements whose text is collected, by their parent element
+# i.e. the title of a page or the timestamp of a revision
+collected_tags = {'page': {'title', 'ns'},
+                  'revision': {'timestamp', 'sha1', 'text'},
+                  'contributor': {'username', 'ip'}}
+
+# Bytes of each revision text digest
+DIGEST_SIZE = 16
+
+
+# ---------------------------------------------------------------------
+# expat Handlers for Light Dump Conversion
+# ---------------------------------------------------------------------
+
+class LightDumpHandler:
+    """
+    expat handlers that keep only what the light dump needs from each page:
+    the title and namespace, and the timestamp, sha1 and contributor of every
+    revision. The text of each revision is only ever compared with the text
+    of other revisions within its page, so it is hashed piece by piece as
+    expat hands it over and never held in full, and no element tree is ever
+    built
+    """
+
+    def __init__(self, parser, on_page, editor_ids, page_filter=None):
+        """
+        :param parser: expat parser to handle the events of
+        :param on_page: Callback given the page title, the map of every time
+                        to the (text digest, editor id) and the map of every
+                        time to the sha1
+        :param editor_ids: Global editor dictionary (EditorIds)
+        :param page_filter: Filter of pages to convert from
+                            make_page_filter() (None to convert every page)
+        """
+        self.parser = parser
+        self.on_page = on_page
+        self.editor_ids = editor_ids
+        self.page_filter = page_filter
+        self.num_filtered = 0
+        # Byte offsets of the first page (the size of the header before it)
+        # and of the current page in the XML fed to the parser
+        self.header_size, self.page_offset = None, None
+        # Names of the open elements
+        self.path = []
+        # Text being collected
+        self.collecting, self.buf = None, []
+        # Length and running hash of the revision text being read
+        self.text_len, self.text_hash = 0, None
+        self.reset_page()
+
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        # Hands over the text of each element in one piece rather than line
+        # by line
+        parser.buffer_text = True
+        parser.buffer_size = FEED_SIZE
+
+    def reset_page(self):
+        self.page = {}
+        self.keep = None if self.page_filter else True
+        self.time_mapper, self.sha1_mapper = {}, {}
+
+    def check_page(self):
+        """
+        Checks the page filter once the page header is parsed
+        """
+        if self.keep is None:
+            ns = self.page.get('ns')
+            self.keep = self.page_filter(self.page.get('title'),
+                                         int(ns) if ns else None)
+
+    def start(self, name, attrib):
+        parent = self.path[-1] if self.path else None
+        self.path.append(name)
+
+        if name == 'page':
+            self.page_offset = self.parser.CurrentByteIndex
+            if self.header_size is None:
+                self.header_size = self.page_offset
+        elif name == 'revision' and parent == 'page':
+            self.check_page()
+            self.rev = {}
+        elif not self.keep and parent != 'page':
+            return
+        # Character data is only handed over for the elements collected, so
+        # the whitespace between every other element costs nothing
+        elif name == 'text' and parent == 'revision':
+            self.collecting = name
+            self.text_len = 0
+            self.text_hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+            self.parser.CharacterDataHandler = self.update_text
+        elif name in collected_tags.get(parent, ()):
+            self.collecting, self.buf = name, []
+            self.parser.CharacterDataHandler = self.buf.append
+
+    def update_text(self, data):
+        """
+        Adds a piece of revision text to its hash
+        :param data: Text as handed over by expat
+        """
+        self.text_len += len(data)
+        self.text_hash.update(data.encode('utf-8'))
+
+    def end(self, name):
+        self.path.pop()
+        parent = self.path[-1] if self.path else None
+
+        if self.collecting == name:
+            self.collecting = None
+            self.parser.CharacterDataHandler = None
+            if name == 'text':
+                # Empty and deleted texts are None, the same as their .text
+                self.rev['text'] = (self.text_len, self.text_hash.digest()) \
+                    if self.text_len else None
+                self.text_hash = None
+            elif parent == 'page':
+                self.page[name] = ''.join(self.buf) or None
+            else:
+                self.rev[name] = ''.join(self.buf) or None
+        elif name == 'revision' and self.keep:
+            user = self.rev.get('username') or self.rev.get('ip')
+            timestamp = self.rev.get('timestamp')
+            self.time_mapper[timestamp] = (self.rev.get('text'),
+                                           self.editor_ids.get_id(user))
+            self.sha1_mapper[timestamp] = self.rev.get('sha1')
+        elif name == 'page':
+            self.check_page()
+            if self.keep:
+                self.on_page(self.page.get('title'), self.time_mapper,
+                             self.sha1_mapper)
+            else:
+                self.num_filtered += 1
+            self.reset_page()
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for Converting with expat
+# ---------------------------------------------------------------------
+
+def stream_to_light_format(xml_fh, fp_txt, out_dir, editor_ids, fh=None,
+                           page_handler=None, skip_pages=0,
+                           checkpoint_every=0, prune=0, page_filter=None,
+                           ckpt=None, params_hash=None):
+    """
+    Converts the XML file to light formatted data with LightDumpHandler,
+    the same as context_to_txt() does for the light format
+    Unlike lxml, expat reports exactly where each page starts, so its
+    checkpoints record the offset of the next page to convert and resuming
+    seeks straight there after parsing the header
+    :param xml_fh: Binary file handle of the XML file
+    :param fp_txt: File path for output
+    :param out_dir: Output directory
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param fh: Light dump writer (None to skip writing the light dump)
+    :param page_handler: Optional callback given each page's title, revision
+                         order and editor order
+    :param skip_pages: Number of pages already converted by a previous run
+    :param checkpoint_every: Number of pages between checkpoints of the
+                             light dump (0 for no checkpoints)
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts
+    :param page_filter: Filter of pages to convert from make_page_filter()
+                        (None to convert every page)
+    :param ckpt: Checkpoint being resumed from, seeked to if it has the
+                 input offsets (None to start from the first page)
+    :param params_hash: Hash of the params of the output, kept with its
+                        checkpoints
+    :return: Number of pages converted
+    """
+    fp_ckpt = get_checkpoint_fp(out_dir + fp_txt)
+    page_num = 0
+    # Offset in the file of the start of the XML fed to the parser
+    base_offset = 0
+
+    def on_page(page_title, time_mapper, sha1_mapper):
+        nonlocal page_num
+        page_num += 1
+        # Already converted before resuming
+        if page_num <= skip_pages:
+            return
+
+        # Everything before this page is written, so save a checkpoint
+        if (checkpoint_every and fh is not None and page_num > 1 and
+                page_num - 1 > skip_pages and
+                not (page_num - 1) % checkpoint_every):
+            editor_ids.save()
+            write_checkpoint(fp_ckpt, {
+                'params': params_hash,
+                'pages': page_num - 1,
+                'header_size': handler.header_size,
+                'input_offset': handler.page_offset + base_offset,
+                'light_dump': fh.checkpoint(),
+                'csv_offset': None,
+                'done': 0
+            })
+
+        if prune and can_prune_page(time_mapper, sha1_mapper):
+            convert_pruned_page_light_format(page_title, time_mapper, fh=fh,
+                                             page_handler=page_handler)
+        else:
+            convert_page_light_format(page_title, time_mapper, editor_ids,
+                                      fh=fh, page_handler=page_handler)
+        if not page_num % 1000:
+            print('converted up to {}'.format(page_num))
+
+    parser = expat.ParserCreate()
+    handler = LightDumpHandler(parser, on_page, editor_ids, page_filter)
+    # Feeds the header (the root element and siteinfo) and then carries on
+    # from the first page not yet converted
+    if ckpt and ckpt.get('input_offset') is not None:
+        parser.Parse(xml_fh.read(ckpt['header_size']), False)
+        xml_fh.seek(ckpt['input_offset'])
+        base_offset = ckpt['input_offset'] - ckpt['header_size']
+        page_num, skip_pages = ckpt['pages'], 0
+    for chunk in iter(lambda: xml_fh.read(FEED_SIZE), b''):
+        parser.Parse(chunk, False)
+    parser.Parse(b'', True)
+    if page_filter:
+        print('Filtered out {} pages'.format(handler.num_filtered))
+    return page_num
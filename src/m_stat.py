@@ -1,6 +1,29 @@
+import os
+import re
+import shutil
 import sys
-import pandas as pd
 from csv import writer
+from collections import Counter
+from datetime import datetime, timezone
+from editors import EditorIds, get_editor_ids_fp
+from light_io import get_light_dump_name, get_xml_light_dump_name,\
+    open_light_dump, resolve_light_dump
+from snapshots import MStatState, SnapshotWriter, get_page_snapshot_dir,\
+    get_page_snapshot_fps, get_snapshot_fps, write_page_snapshots
+from checkpoint import get_checkpoint_fp, hash_checkpoint_params,\
+    load_checkpoint, remove_checkpoint, truncate_file, write_checkpoint
+
+# Edit number and editor name/IP address of each revision line
+# i.e. ^^^_2019-05-17T01:24:12Z 0 493 JJMC89 -> (b'493', b'JJMC89')
+rev_line_re = re.compile(rb'^\^\^\^[^ \t\n]*[ \t]+[^ \t\n]+[ \t]+(\d+)[ \t]+' +
+                         rb'([^ \t\r\n]+)', re.M)
+# Title lines are any lines that do not start with ^^^
+# Pruned pages have a single summary line in place of their revisions
+# i.e. ^^^= 493 201 -> 493 edits by 201 editors
+title_line_re = re.compile(rb'\n(?!\^\^\^)')
+
+# Bytes read from the light dump at a time
+PARSE_CHUNK_SIZE = 16 * 1024 * 1024
 
 
 # ---------------------------------------------------------------------
@@ -106,8 +129,33 @@ def get_m_stat(rev_order, editor_order, num_edits_dict, extra_stats=0):
     return res_stats
 
 
-def update_line(line, editor_mapper, editor_count, num_edits_dict,
-                editor_order, rev_order):
+def get_page_m_stat(rev_order, editor_order, extra_stats=0):
+    """
+    Gets the M-Statistic of a single page straight from its revision order
+    and editor order, without going through the light dump text
+    :param rev_order: Order of revisions/edits (latest to earliest)
+    :param editor_order: Order of editors (latest to earliest)
+    :param extra_stats: Flag for extra statistics
+    :return: M-Statistic and possibly extra statistics
+    """
+    num_edits_dict = Counter(editor_order)
+    return get_m_stat(rev_order, editor_order, num_edits_dict, extra_stats)
+
+
+def get_pruned_m_stat(summary, extra_stats=0):
+    """
+    Gets the M-Statistic of a page pruned during processing, which had no
+    reverts
+    :param summary: Number of edits and number of editors of the page
+    :param extra_stats: Flag for extra statistics
+    :return: M-Statistic and possibly extra statistics
+    """
+    if not extra_stats:
+        return [0]
+    return [0, summary[0], 0, summary[1], 0]
+
+
+def update_line(line, editor_ids, num_edits_dict, editor_order, rev_order):
     """
     Updates various tracking dictionaries for future use in calculating
     M-Statistic with values extracted from a line in the light dump data
@@ -117,22 +165,139 @@ def update_line(line, editor_mapper, editor_count, num_edits_dict,
     We only really need the edit number and editor name/IP address, which
     can be reasoned in get_m_stat()
     :param line: Current line in light dump
-    :param editor_mapper: Maps editors to a unique identifier
-    :param editor_count: Number of editors seen thus far in an article
+    :param editor_ids: Global editor dictionary (EditorIds)
     :param num_edits_dict: Maps editor id to number of respective edits
     :param editor_order: Ordering so far of editor
     :param rev_order: Revision order
-    :return: Updated number of editors
     """
     line = line.split()
-    if line[3] not in editor_mapper:
-        editor_mapper[line[3]] = editor_count
-        num_edits_dict[editor_mapper[line[3]]] = 0
-        editor_count += 1
-    num_edits_dict[editor_mapper[line[3]]] += 1
-    editor_order.append(editor_mapper[line[3]])
+    # Summary of a pruned page
+    if line[0] == '^^^=':
+        return
+    editor_id = editor_ids.get_id(line[3])
+    num_edits_dict[editor_id] = num_edits_dict.get(editor_id, 0) + 1
+    editor_order.append(editor_id)
     rev_order.append(int(line[2]))
-    return editor_count
+
+
+def get_m_stat_name(fp, prefix='m-stat-'):
+    """
+    Gets the output file name for the M-Statistics of a light dump
+    i.e. light-dump-Anarchism.txt.gz -> m-stat-Anarchism.csv
+    :param fp: File name of the plain or compressed light dump
+    :param prefix: Prefix of the output ('overtime-' for over time)
+    :return: File name of the M-Statistic csv
+    """
+    return prefix + get_light_dump_name(fp).replace('.txt', '.csv')\
+        .replace('light-dump-', '')
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses a light dump timestamp without needing pandas
+    i.e. 2019-05-17T01:24:12Z -> 2019-05-17 01:24:12+00:00
+    :param timestamp: Timestamp from the light dump
+    :return: Timezone aware datetime
+    """
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')\
+        .replace(tzinfo=timezone.utc)
+
+
+def parse_rev_lines(block, start, end, editor_ids, rev_order, editor_order):
+    """
+    Decodes the edit numbers and editors of every revision line within a
+    section of a block of the light dump at once
+    :param block: Bytes of complete lines from the light dump
+    :param start: Start of the section within the block
+    :param end: End of the section within the block
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param rev_order: Revision order to extend
+    :param editor_order: Editor order to extend
+    :return: Number of edits and editors if the page was pruned, else None
+    """
+    section = block[start:end]
+    summary = None
+    if section[:4] == b'^^^=':
+        line_end = section.find(b'\n') + 1 or len(section)
+        fields = section[:line_end].split()
+        summary = (int(fields[1]), int(fields[2]))
+        section = section[line_end:]
+    fields = section.split()
+    num_lines = section.count(b'\n')
+    # Nearly every revision line has exactly four fields, so each field can
+    # be sliced out of one big split of the section. The fields only line up
+    # when the sole '^^^' in the section start its lines and every fourth
+    # field is one of them, otherwise the regex handles it line by line
+    if len(fields) == 4 * num_lines and \
+            section.count(b'^^^') == num_lines and \
+            b' '.join(fields[0::4]).count(b'^^^') == num_lines:
+        revs, editors = fields[2::4], fields[3::4]
+    else:
+        matches = rev_line_re.findall(section)
+        if not matches:
+            return summary
+        revs, editors = zip(*matches)
+
+    rev_order.extend(map(int, revs))
+    editor_order.extend(editor_ids.get_ids_from_bytes(editors))
+    return summary
+
+
+def iter_light_dump_pages(fh, editor_ids, offset=0,
+                          chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parses the light dump in large chunks rather than line by line, yielding
+    every page with its revision order and editor order ready for
+    get_m_stat()
+    :param fh: Binary file object of the light dump
+    :param editor_ids: Global editor dictionary (EditorIds)
+    :param offset: Offset of fh within the light dump
+    :param chunk_size: Bytes to read at a time
+    :return: Generator of (offset of the title line, title, revision order,
+             editor order, summary) for every page, where summary is the
+             number of edits and editors of pruned pages and otherwise None
+    """
+    title, title_offset, rev_order, editor_order = None, None, [], []
+    summary = None
+    carry = b''
+    while True:
+        chunk = fh.read(chunk_size)
+        block = carry + chunk
+        # Only complete lines are parsed, the rest carries over
+        cut = block.rfind(b'\n') + 1 if chunk else len(block)
+        block, carry = block[:cut], block[cut:]
+        if not chunk and block and block[-1:] != b'\n':
+            block += b'\n'
+
+        # Start of every title line within the block
+        title_starts = [match.end() for match in title_line_re.finditer(block)]
+        if block and block[:3] != b'^^^':
+            title_starts.insert(0, 0)
+
+        pos = 0
+        for start in title_starts:
+            if start == len(block):
+                break
+            # Revisions before the title belong to the current page
+            if title is not None:
+                summary = parse_rev_lines(block, pos, start, editor_ids,
+                                          rev_order, editor_order) or summary
+                yield title_offset, title, rev_order, editor_order, summary
+            pos = block.index(b'\n', start) + 1
+            title = block[start:pos].decode('utf-8').rstrip()
+            title_offset = offset + start
+            rev_order, editor_order, summary = [], [], None
+        if title is not None:
+            summary = parse_rev_lines(block, pos, len(block), editor_ids,
+                                      rev_order, editor_order) or summary
+        offset += len(block)
+
+        if not chunk:
+            break
+
+    # Last page edge case
+    if title is not None:
+        yield title_offset, title, rev_order, editor_order, summary
 
 
 # ---------------------------------------------------------------------
@@ -144,85 +309,247 @@ def get_m_stat_data(data_dir='data/',
                          "xml-p10p1036.txt",
                          "light-dump-enwiki-20200101-pages-meta-history1-" +
                          "xml-p1037p2031.txt"),
-                    extra_stats=0
+                    extra_stats=0,
+                    checkpoint_every=0,
+                    resume=0,
+                    snapshot_every=0
                     ):
     """
     Gets the M-Statistic for each article in the light dump formatted data
     :param data_dir: directory where the data lies within : - )
-    :param fps: Filepaths
+    :param fps: Filepaths of plain or compressed light dumps
     :param extra_stats: Flag for extra statistics
+    :param checkpoint_every: Number of pages between checkpoints of the
+                             M-Statistic output (0 for no checkpoints)
+    :param resume: Whether or not to resume each file from its last
+                   checkpoint instead of starting over
+    :param snapshot_every: Number of revisions between snapshots of each
+                           page's M-Statistic state, so any article can be
+                           queried over time with query_m_stat()
+                           (0 to not keep snapshots)
     """
 
     out_dir = '{}out/'.format(data_dir)
     out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+    editor_ids = EditorIds(get_editor_ids_fp(data_dir))
 
     # Maintain for page_id
     page_count = 0
 
     # Iterate through filepaths
     for fp in fps:
+        fp_csv = out_m_stat_dir + get_m_stat_name(fp)
+        fp_ckpt = get_checkpoint_fp(fp_csv)
+
+        # Picks up from the last consistent checkpoint of the output, as
+        # long as it was made with the same params from the same light dump
+        fp_in = resolve_light_dump(out_dir + fp)
+        params_hash = hash_checkpoint_params({
+            'extra_stats': extra_stats, 'snapshot_every': snapshot_every,
+            'light_dump': [fp_in, os.path.getsize(fp_in)]
+            if os.path.exists(fp_in) else None
+        })
+        ckpt = load_checkpoint(fp_ckpt, params_hash) if resume else None
+        if ckpt and ckpt['done']:
+            print('Already have {}. Skipping'.format(fp_csv))
+            page_count = ckpt['page_count']
+            continue
+        in_offset = 0
+        if ckpt:
+            print('Resuming {} from page {}'.format(fp, ckpt['page_count']))
+            truncate_file(fp_csv, ckpt['out_offset'])
+            in_offset, page_count = ckpt['in_offset'], ckpt['page_count']
+        else:
+            remove_checkpoint(fp_ckpt)
+
+        # Index of every page, plus snapshot stores of the long ones
+        pages_fh, snapshot_dir = None, None
+        if snapshot_every:
+            snapshot_dir = get_page_snapshot_dir(out_m_stat_dir, fp)
+            if ckpt:
+                truncate_file(snapshot_dir + 'pages.idx',
+                              ckpt['pages_offset'])
+            else:
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                os.makedirs(snapshot_dir)
+            pages_fh = open(snapshot_dir + 'pages.idx', 'ab')
+
+        def write_page(page, page_end):
+            """
+            Adds a page to the page index and writes its snapshots if it
+            is long enough to have any
+            :param page: Title offset, title and number of revisions
+            :param page_end: Offset of the next title (None at the end)
+            """
+            title_offset, title, num_revs = page
+            if num_revs >= snapshot_every:
+                with open_light_dump(out_dir + fp, offset=title_offset,
+                                     binary=True) as page_fh:
+                    page_data = page_fh.read(
+                        -1 if page_end is None else page_end - title_offset)
+                page_end = title_offset + len(page_data)
+                write_page_snapshots(
+                    get_page_snapshot_fps(snapshot_dir, title_offset),
+                    page_data.splitlines(keepends=True), page_end,
+                    snapshot_every
+                )
+            pages_fh.write('{} {} {} {}\n'.format(
+                title_offset, '-' if page_end is None else page_end,
+                num_revs, title).encode('utf-8'))
+        # Pages are only written once the next title gives their end
+        prev_page = None
+
         # Writer for current filepath
-        page_id_write_obj = \
-            open(
-                '{}m-stat-{}'.format(
-                    out_m_stat_dir,
-                    fp.replace('.txt', '.csv').replace('light-dump-', '')
-                ),
-                'w', newline=''
-            )
+        page_id_write_obj = open(fp_csv, 'a' if ckpt else 'w', newline='')
         page_id_fp_csv_writer = writer(page_id_write_obj)
 
         # Starter csv header
-        title_id, title, m_stats = 'Title_ID', 'Title', ['M-Statistic']
-        if extra_stats:
-            m_stats.extend(['Num Edits', 'Num Reverts', 'Num Editors',
-                            'Num Mutual Editors'])
+        if not ckpt:
+            header = ['Title_ID', 'Title', 'M-Statistic']
+            if extra_stats:
+                header.extend(['Num Edits', 'Num Reverts', 'Num Editors',
+                               'Num Mutual Editors'])
+            page_id_fp_csv_writer.writerow(header)
+
+        # Iterates through each page in the light dump file
+        fh = open_light_dump(out_dir + fp, offset=in_offset, binary=True)
+        for title_offset, title, rev_order, editor_order, summary in\
+                iter_light_dump_pages(fh, editor_ids, offset=in_offset):
+            if prev_page:
+                write_page(prev_page, title_offset)
+            if snapshot_every:
+                prev_page = (title_offset, title, len(rev_order))
+
+            # Everything before this article is written, so save a
+            # checkpoint
+            if (checkpoint_every and page_count and
+                    not page_count % checkpoint_every):
+                editor_ids.save()
+                page_id_write_obj.flush()
+                if pages_fh:
+                    pages_fh.flush()
+                write_checkpoint(fp_ckpt, {
+                    'params': params_hash,
+                    'page_count': page_count,
+                    'in_offset': title_offset,
+                    'out_offset': page_id_write_obj.tell(),
+                    'pages_offset': pages_fh.tell() if pages_fh else None,
+                    'done': 0
+                })
+
+            # Calculates M-Statistic
+            next_row = [page_count, title]
+            if summary:
+                next_row.extend(get_pruned_m_stat(summary, extra_stats))
+            else:
+                next_row.extend(get_page_m_stat(rev_order, editor_order,
+                                                extra_stats))
+            # Writes article_id, title, and M-Statistic to file
+            page_id_fp_csv_writer.writerow(next_row)
 
-        # Initializes for no good reason
-        editor_order, num_edits_dict, editor_mapper, rev_order, editor_count =\
-            [], {}, {}, [], 0
+            page_count += 1
+            if not page_count % 100000:
+                print('Done parsing', page_count, 'pages')
+        fh.close()
+        if prev_page:
+            write_page(prev_page, None)
+        if pages_fh:
+            pages_fh.close()
+
+        page_id_write_obj.close()
+        editor_ids.save()
+        if checkpoint_every:
+            write_checkpoint(fp_ckpt, {'params': params_hash,
+                                       'page_count': page_count,
+                                       'in_offset': None,
+                                       'out_offset': None,
+                                       'pages_offset': None, 'done': 1})
+        print('Done with {}!'.format(fp))
 
-        line_num = -1
-        # Iterates through each line in the light dump file
-        for line in open(out_dir + fp):
-            line_num += 1
-            # Removes end newline characters
-            line = line.rstrip()
-
-            # Passes at the start of the next article
-            if '^^^' != line[:3]:
-                next_row = [title_id, title]
-                # Calculates M-Statistic
-                if not m_stats:
-                    m_stats = get_m_stat(rev_order, editor_order,
-                                         num_edits_dict, extra_stats)
-                next_row.extend(m_stats)
-                # Writes article_id, title, and M-Statistic to file
-                page_id_fp_csv_writer.writerow(next_row)
 
-                # Sets up for next article
-                title_id, title, m_stats = page_count, line, None
-                editor_order, num_edits_dict, editor_mapper, rev_order = \
-                    [], {}, {}, []
-                editor_count = 0
+# ---------------------------------------------------------------------
+# Driver Function for GETTING M_STATISTICS STRAIGHT FROM XML
+# ---------------------------------------------------------------------
+
+def get_m_stat_from_xml(data_dir='data/',
+                        fps=('enwiki-20200101-pages-meta-history1.xml-p10p1036',
+                             'enwiki-20200101-pages-meta-history1.xml-p1037p2031'),
+                        extra_stats=0,
+                        light_dump=0,
+                        compression=None,
+                        prune=0,
+                        namespaces=None,
+                        title_include=None,
+                        title_exclude=None,
+                        title_list_fp=None,
+                        parser_type=0
+                        ):
+    """
+    Fused processing and M-Statistic in a single pass over the XML files
+    Each page's revision order and editor order is handed straight to the
+    scorer in memory instead of being written to and re-read from the light
+    dump text file. Output matches process_data() followed by
+    get_m_stat_data()
+    :param data_dir: Directory for data
+    :param fps: File paths of the unzipped XML files
+    :param extra_stats: Flag for extra statistics
+    :param light_dump: Whether or not to still write the light dump text file
+    :param compression: Compression for the light dump ('gzip', 'zstd' or
+                        None for plain text)
+    :param prune: Whether or not to write only a summary of pages without
+                  reverts to the light dump
+    :param namespaces: Namespaces of pages to keep (None to keep all)
+    :param title_include: Regex patterns, keeping only titles that match at
+                          least one (None to keep all)
+    :param title_exclude: Regex patterns, dropping titles that match any
+    :param title_list_fp: File path of a list of titles to keep, one per
+                          line (None to keep all)
+    :param parser_type: XML parser (0 for iterparse, 1 for the text
+                        discarding expat parser)
+    """
+    # Only this driver needs lxml, so it is imported here
+    from etl import make_page_filter, unzip_to_txt
+
+    out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+    editor_ids = EditorIds(get_editor_ids_fp(data_dir))
+    page_filter = make_page_filter(namespaces, title_include, title_exclude,
+                                   title_list_fp)
+
+    # Maintain for page_id
+    page_count = 0
+
+    for fp_unzip in fps:
+        print('Starting with {}'.format(fp_unzip))
+        fp_light = get_xml_light_dump_name(fp_unzip)
+        with open(out_m_stat_dir + get_m_stat_name(fp_light), 'w',
+                  newline='') as page_id_write_obj:
+            page_id_fp_csv_writer = writer(page_id_write_obj)
+
+            # Starter csv header
+            header = ['Title_ID', 'Title', 'M-Statistic']
+            if extra_stats:
+                header.extend(['Num Edits', 'Num Reverts', 'Num Editors',
+                               'Num Mutual Editors'])
+            page_id_fp_csv_writer.writerow(header)
+
+            def page_handler(title, rev_order, editor_order):
+                # Writes article_id, title, and M-Statistic to file
+                nonlocal page_count
+                m_stats = get_page_m_stat(rev_order, editor_order,
+                                          extra_stats)
+                page_id_fp_csv_writer.writerow([page_count, title] + m_stats)
                 page_count += 1
                 if not page_count % 100000:
                     print('Done parsing', page_count, 'pages')
-                continue
 
-            # Updates the necessary information used to calculate the M-Stat
-            editor_count = update_line(line, editor_mapper, editor_count,
-                                       num_edits_dict, editor_order, rev_order)
+            unzip_to_txt(data_dir=data_dir, fp_unzip=fp_unzip, tags=set(),
+                         out_format=0, page_handler=page_handler,
+                         light_dump=light_dump, editor_ids=editor_ids,
+                         compression=compression, prune=prune,
+                         page_filter=page_filter, parser_type=parser_type)
 
-        # Last article edge case
-        if not m_stats:
-            next_row = [title_id, title]
-            m_stats = get_m_stat(rev_order, editor_order, num_edits_dict,
-                                 extra_stats)
-            next_row.extend(m_stats)
-            page_id_fp_csv_writer.writerow(next_row)
-
-        print('Done with {}!'.format(fp))
+        editor_ids.save()
+        print('Done with {}!'.format(fp_unzip))
 
 
 # ---------------------------------------------------------------------
@@ -231,12 +558,16 @@ def get_m_stat_data(data_dir='data/',
 
 def grab_m_stat_over_time(data_dir='data/',
                           fps=('light-dump-Anarchism.txt',
-                               'light-dump-Abortion.txt')):
+                               'light-dump-Abortion.txt'),
+                          snapshot_every=0):
     """
     Intended for only getting the M-Statistic over time for plotting
     Used when raw_data is just one file with the history of just one page
     :param fps: The raw light dump filepaths with just one article each
     :param data_dir: The directory for output
+    :param snapshot_every: Number of revisions between snapshots of the
+                           M-Statistic state for point in time queries
+                           (0 to not keep snapshots)
     :return: None
     """
 
@@ -246,33 +577,43 @@ def grab_m_stat_over_time(data_dir='data/',
     for fp in fps:
         # File location for resulting M-Statistic over time
         page_id_write_obj = \
-            open('{}overtime-{}'.format(
-                out_m_stat_dir,
-                fp.replace('.txt', '.csv').replace('light-dump-', '')
-            ), 'w+', newline=''
-            )
+            open(out_m_stat_dir + get_m_stat_name(fp, prefix='overtime-'),
+                 'w+', newline='')
         page_id_fp_csv_writer = writer(page_id_write_obj)
-
-        editor_order, num_edits_dict, editor_mapper, rev_order, editor_count =\
-            [], {}, {}, [], 0
-
-        line_num = -1
         page_id_fp_csv_writer.writerow(['Timestamp', 'M-Statistic'])
+
         # Iterates through each line in the light dump file
-        for line in reversed(list(open(out_dir + fp))):
-            line_num += 1
-            # Removes end newline characters
-            line = line.rstrip()
+        with open_light_dump(out_dir + fp, binary=True) as fh:
+            lines = fh.readlines()
+        line_offset = sum(map(len, lines))
+        snapshot_writer = SnapshotWriter(
+            get_snapshot_fps(out_m_stat_dir, fp), line_offset) \
+            if snapshot_every else None
+
+        m_stat_state = MStatState()
+        # Goes from the earliest revision to the latest
+        for line in reversed(lines):
+            line_offset -= len(line)
+            line = line.decode('utf-8').split()
 
             # Start of next page
-            if '^^^' != line[:3]:
+            if not line or '^^^' != line[0][:3]:
+                continue
+            # Pruned pages have no revisions to go through
+            if line[0] == '^^^=':
+                print('{} was pruned, process it without prune for its '
+                      'M-Statistic over time'.format(fp))
                 continue
 
-            editor_count = update_line(line, editor_mapper, editor_count,
-                                       num_edits_dict, editor_order, rev_order)
-            m_stat_val = get_m_stat(rev_order[::-1], editor_order[::-1],
-                                    num_edits_dict)[0]
+            m_stat_state.update(int(line[2]), line[3])
             page_id_fp_csv_writer.writerow([
-                pd.to_datetime(line.split()[0][4:]), m_stat_val
+                parse_timestamp(line[0][4:]), m_stat_state.m_stat()[0]
                 ])
+            if snapshot_writer and \
+                    not m_stat_state.rev_count % snapshot_every:
+                snapshot_writer.write(m_stat_state, line[0][4:], line_offset)
+
+        page_id_write_obj.close()
+        if snapshot_writer:
+            snapshot_writer.close()
         print('Done with', fp)
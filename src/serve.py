@@ -0,0 +1,363 @@
+import glob
+import hashlib
+import json
+import os
+from csv import reader
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from light_io import get_article_light_dump_name
+from m_stat import get_m_stat_name
+from snapshots import get_m_stat_range, normalize_query_time
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for the M-Statistic Index
+# ---------------------------------------------------------------------
+# The index is built once from the m-stat-*.csv files and cached as .npy
+# files in out_m_stat/index/, which are memory-mapped when served:
+#   ids.npy, stats.npy        -> Title_ID and statistics of every row
+#   titles.bin, title_offsets -> utf-8 titles back to back and where each
+#                                row's title starts
+#   title_hashes, title_rows  -> sorted title hashes and their rows
+#   ids_sorted, id_rows       -> sorted Title_IDs and their rows
+#   m_sorted, m_rows          -> sorted M-Statistics and their rows
+# meta.json holds the columns and the size/mtime of every csv, so the index
+# is rebuilt whenever the results change
+
+INDEX_ARRAYS = ('ids', 'stats', 'title_offsets', 'title_hashes',
+                'title_rows', 'ids_sorted', 'id_rows', 'm_sorted', 'm_rows')
+
+# Most rows a single /top or /range query returns
+MAX_PAGE_SIZE = 1000
+
+
+def hash_title(title):
+    """
+    :param title: Title of an article
+    :return: 64 bit hash of the title
+    """
+    return int.from_bytes(hashlib.blake2b(title.encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+def get_sources(out_m_stat_dir):
+    """
+    Gets the M-Statistic csvs and their sizes and mtimes
+    :param out_m_stat_dir: Directory for M-Statistic output
+    :return: List of [file path, size, mtime]
+    """
+    return [[fp, os.path.getsize(fp), os.path.getmtime(fp)]
+            for fp in sorted(glob.glob(out_m_stat_dir + 'm-stat-*.csv'))]
+
+
+def build_index(out_m_stat_dir, index_dir, sources):
+    """
+    Builds the index from the M-Statistic csvs
+    :param out_m_stat_dir: Directory for M-Statistic output
+    :param index_dir: Directory for the index
+    :param sources: M-Statistic csvs from get_sources()
+    """
+    columns, ids, stats, titles = None, [], [], []
+    for fp, _, _ in sources:
+        with open(fp, newline='') as fh:
+            csv_reader = reader(fh)
+            header = next(csv_reader, None)
+            if columns is None:
+                columns = header
+            if header != columns:
+                print('Skipping {}, its columns differ from {}'.format(
+                    fp, columns))
+                continue
+            for row in csv_reader:
+                ids.append(int(row[0]))
+                titles.append(row[1])
+                stats.append([int(float(val)) for val in row[2:]])
+    print('Indexing {} rows'.format(len(ids)))
+    columns = columns or ['Title_ID', 'Title', 'M-Statistic']
+
+    title_bytes = [title.encode('utf-8') for title in titles]
+    title_offsets = np.zeros(len(titles) + 1, dtype=np.int64)
+    np.cumsum([len(title) for title in title_bytes], out=title_offsets[1:])
+    with open(index_dir + 'titles.bin', 'wb') as fh:
+        fh.write(b''.join(title_bytes))
+
+    ids = np.array(ids, dtype=np.int64)
+    stats = np.array(stats, dtype=np.int64).reshape(len(ids),
+                                                    len(columns) - 2)
+    hashes = np.array([hash_title(title) for title in titles],
+                      dtype=np.uint64)
+    title_rows = np.argsort(hashes, kind='stable')
+    id_rows = np.argsort(ids, kind='stable')
+    m_rows = np.argsort(stats[:, 0], kind='stable') if len(ids) else ids
+    arrays = {
+        'ids': ids, 'stats': stats, 'title_offsets': title_offsets,
+        'title_hashes': hashes[title_rows], 'title_rows': title_rows,
+        'ids_sorted': ids[id_rows], 'id_rows': id_rows,
+        'm_sorted': stats[m_rows, 0] if len(ids) else ids, 'm_rows': m_rows
+    }
+    for name in INDEX_ARRAYS:
+        np.save('{}{}.npy'.format(index_dir, name), arrays[name])
+
+    # Written last, so a half built index is never picked up
+    with open(index_dir + 'meta.json', 'w') as fh:
+        json.dump({'columns': columns, 'sources': sources}, fh)
+
+
+class MStatIndex:
+    """
+    Memory-mapped index over the M-Statistic results
+    """
+
+    def __init__(self, data_dir='data/'):
+        """
+        :param data_dir: Directory for data
+        """
+        out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+        index_dir = '{}index/'.format(out_m_stat_dir)
+        os.makedirs(index_dir, exist_ok=True)
+
+        sources = get_sources(out_m_stat_dir)
+        meta = None
+        if os.path.exists(index_dir + 'meta.json'):
+            with open(index_dir + 'meta.json') as fh:
+                meta = json.load(fh)
+        if meta is None or meta['sources'] != sources:
+            print('Building index of', out_m_stat_dir)
+            build_index(out_m_stat_dir, index_dir, sources)
+            with open(index_dir + 'meta.json') as fh:
+                meta = json.load(fh)
+
+        self.columns = meta['columns']
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load('{}{}.npy'.format(index_dir, name),
+                                        mmap_mode='r'))
+        self.titles = np.memmap(index_dir + 'titles.bin', dtype=np.uint8,
+                                mode='r') \
+            if self.title_offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_title(self, row):
+        """
+        :param row: Row of the index
+        :return: Title of the row
+        """
+        return self.titles[self.title_offsets[row]:
+                           self.title_offsets[row + 1]].tobytes()\
+            .decode('utf-8')
+
+    def get_row(self, row):
+        """
+        :param row: Row of the index
+        :return: Dictionary of the row's columns
+        """
+        res = {self.columns[0]: int(self.ids[row]),
+               self.columns[1]: self.get_title(row)}
+        res.update(zip(self.columns[2:], map(int, self.stats[row])))
+        return res
+
+    def by_title(self, title):
+        """
+        :param title: Title of an article
+        :return: Rows with the title
+        """
+        title_hash = np.uint64(hash_title(title))
+        lo = np.searchsorted(self.title_hashes, title_hash, 'left')
+        hi = np.searchsorted(self.title_hashes, title_hash, 'right')
+        # Checks the titles themselves in case of hash collisions
+        return [self.get_row(row) for row in self.title_rows[lo:hi]
+                if self.get_title(row) == title]
+
+    def by_id(self, title_id):
+        """
+        :param title_id: Title_ID of an article
+        :return: Rows with the Title_ID
+        """
+        lo = np.searchsorted(self.ids_sorted, title_id, 'left')
+        hi = np.searchsorted(self.ids_sorted, title_id, 'right')
+        return [self.get_row(row) for row in self.id_rows[lo:hi]]
+
+    def by_m_stat_range(self, min_m_stat, max_m_stat, limit=100):
+        """
+        :param min_m_stat: Lowest M-Statistic
+        :param max_m_stat: Highest M-Statistic
+        :param limit: Most rows to return
+        :return: Number of rows in the range and up to limit of them, in
+                 ascending M-Statistic
+        """
+        lo = np.searchsorted(self.m_sorted, min_m_stat, 'left')
+        hi = np.searchsorted(self.m_sorted, max_m_stat, 'right')
+        return int(max(hi - lo, 0)), [self.get_row(row) for row in
+                                      self.m_rows[lo:min(hi, lo + limit)]]
+
+    def top(self, n=10):
+        """
+        :param n: Number of rows
+        :return: Rows with the n highest M-Statistics
+        """
+        return [self.get_row(row) for row in self.m_rows[::-1][:n]]
+
+
+def read_evolution(data_dir, article, start=None, end=None):
+    """
+    Gets the M-Statistic over time of an article, from its snapshots when
+    given a time range or from its overtime csv otherwise
+    :param data_dir: Directory for data
+    :param article: Article name as in its light dump file name
+    :param start: Light dump formatted timestamp to start from
+    :param end: Light dump formatted timestamp to end at
+    :return: List of [light dump formatted timestamp, M-Statistic]
+    :raises ValueError: If the article name could reach outside data_dir
+    """
+    if '/' in article or '\\' in article or '..' in article:
+        raise ValueError('Bad article name ' + article)
+    fp_light = get_article_light_dump_name(article)
+    if start or end:
+        return [[timestamp, stats[0]] for timestamp, stats in
+                get_m_stat_range(data_dir, fp_light,
+                                 start or '0001-01-01', end or '9999-12-31')]
+    with open('{}out_m_stat/{}'.format(
+            data_dir, get_m_stat_name(fp_light, prefix='overtime-')),
+            newline='') as fh:
+        csv_reader = reader(fh)
+        next(csv_reader, None)
+        # i.e. 2019-05-17 01:24:12+00:00 -> 2019-05-17T01:24:12Z
+        return [['{}T{}Z'.format(row[0][:10], row[0][11:19]), int(row[1])]
+                for row in csv_reader]
+
+
+def get_page_size(query, key, default):
+    """
+    :param query: Query params of a request
+    :param key: Name of the page size param
+    :param default: Page size when not given
+    :return: Page size, capped at MAX_PAGE_SIZE
+    :raises ValueError: If it is not a number or is negative
+    """
+    size = int(query.get(key, default))
+    if size < 0:
+        raise ValueError('{} has to be at least 0'.format(key))
+    return min(size, MAX_PAGE_SIZE)
+
+
+# ---------------------------------------------------------------------
+# HTTP Handler
+# ---------------------------------------------------------------------
+
+class MStatHandler(BaseHTTPRequestHandler):
+    """
+    Answers JSON queries against the MStatIndex of the server:
+        /title?title=Anarchism
+        /id?id=42
+        /range?min=10&max=1000&limit=100
+        /top?n=10
+        /evolution?article=Anarchism&start=2005-01-01&end=2006-01-01
+    /top and /range return at most MAX_PAGE_SIZE rows
+    """
+
+    # Keeps connections alive between requests, without Nagle's algorithm
+    # holding back the body behind the headers
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: vals[0] for key, vals in parse_qs(url.query).items()}
+        index = self.server.index
+        try:
+            if url.path == '/title':
+                res = index.by_title(query['title'])
+            elif url.path == '/id':
+                res = index.by_id(int(query['id']))
+            elif url.path == '/range':
+                count, rows = index.by_m_stat_range(
+                    int(query.get('min', 0)),
+                    int(query.get('max', np.iinfo(np.int64).max)),
+                    get_page_size(query, 'limit', 100))
+                res = {'count': count, 'rows': rows}
+            elif url.path == '/top':
+                res = index.top(get_page_size(query, 'n', 10))
+            elif url.path == '/evolution':
+                start, end = [normalize_query_time(query[key])
+                              if query.get(key) else None
+                              for key in ('start', 'end')]
+                res = self.server.get_evolution(query['article'], start, end)
+            else:
+                return self.send_json(404, {'error': 'Unknown endpoint ' +
+                                                     url.path})
+        except (KeyError, ValueError) as e:
+            return self.send_json(400, {'error': 'Bad query: {}'.format(e)})
+        except FileNotFoundError:
+            return self.send_json(404, {'error': 'No results for ' +
+                                                 query['article']})
+        self.send_json(200, res)
+
+    def send_json(self, status, res):
+        """
+        Sends a JSON response
+        :param status: HTTP status code
+        :param res: JSON serializable response
+        """
+        body = json.dumps(res).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        if not self.server.quiet:
+            super().log_message(*args)
+
+
+def make_server(data_dir='data/', host='127.0.0.1', port=8180,
+                cache_size=256, quiet=0):
+    """
+    Makes the HTTP server over the M-Statistic results
+    :param data_dir: Directory for data
+    :param host: Host to listen on
+    :param port: Port to listen on
+    :param cache_size: Number of evolution series to keep cached
+    :param quiet: Whether or not to stop logging every request
+    :return: ThreadingHTTPServer
+    """
+    # Built before binding, so the port only accepts connections once the
+    # index is ready
+    index = MStatIndex(data_dir)
+    server = ThreadingHTTPServer((host, port), MStatHandler)
+    server.index = index
+    server.quiet = quiet
+
+    @lru_cache(maxsize=cache_size)
+    def get_evolution(article, start, end):
+        return read_evolution(data_dir, article, start, end)
+    server.get_evolution = get_evolution
+    return server
+
+
+# ---------------------------------------------------------------------
+# Driver Function for SERVING M-STATISTICS
+# ---------------------------------------------------------------------
+
+def serve(data_dir='data/', host='127.0.0.1', port=8180, cache_size=256,
+          quiet=0):
+    """
+    Serves lookups of the M-Statistic results over HTTP/JSON until stopped
+    :param data_dir: Directory for data
+    :param host: Host to listen on
+    :param port: Port to listen on
+    :param cache_size: Number of evolution series to keep cached
+    :param quiet: Whether or not to stop logging every request
+    """
+    server = make_server(data_dir, host, port, cache_size, quiet)
+    print('Serving {} rows on http://{}:{}/'.format(
+        len(server.index), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
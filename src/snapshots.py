@@ -0,0 +1,575 @@
+import bisect
+import json
+import os
+import struct
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from light_io import get_light_dump_name, open_light_dump
+
+
+# ---------------------------------------------------------------------
+# Incremental M-Statistic State
+# ---------------------------------------------------------------------
+
+class MStatState:
+    """
+    State of get_m_stat() for the revisions of an article seen so far, fed
+    one revision at a time from earliest to latest, so the M-Statistic of
+    every prefix of the history comes without rescanning it
+    """
+
+    def __init__(self):
+        # Number of revisions seen and the next non-revert edit number
+        self.rev_count, self.next_val = 0, 1
+        # Maps editor to number of edits
+        self.num_edits = Counter()
+        # Maps edit number to the editor of the revision right after it,
+        # i.e. the editor whose work a revert to that edit number undoes
+        self.after_editor = {}
+        # Edit number of the last revision if it was not a revert
+        self.last_mapped = None
+        # Counts reverts between each (reverted editor, reverting editor)
+        self.pairs = Counter()
+        # Last revision's revert as (reverted editor, reverting editor, edit
+        # number). It is dropped if the next revision has the same edit
+        # number, the same as get_m_stat() skipping consecutive versions
+        self.pending = None
+
+    def update(self, rev, editor):
+        """
+        Adds the next revision of the article
+        :param rev: Edit number of the revision
+        :param editor: Editor of the revision
+        """
+        if self.pending is not None:
+            if self.pending[2] != rev:
+                self.pairs[self.pending[0], self.pending[1]] += 1
+            self.pending = None
+        if self.last_mapped is not None:
+            self.after_editor[self.last_mapped] = editor
+            self.last_mapped = None
+
+        self.rev_count += 1
+        self.num_edits[editor] += 1
+        if rev < self.next_val:
+            prev_editor = self.after_editor.get(rev)
+            # Ignores unknown edit numbers and editors reverting themselves
+            if prev_editor is not None and prev_editor != editor:
+                self.pending = (prev_editor, editor, rev)
+        else:
+            self.last_mapped = rev
+            self.next_val += 1
+
+    def m_stat(self, extra_stats=0):
+        """
+        Gets the M-Statistic of the revisions seen so far, the same as
+        get_m_stat() on them
+        :param extra_stats: Flag for extra statistics
+        :return: M-Statistic and possibly extra statistics
+        """
+        pairs = self.pairs
+        if self.pending is not None:
+            pairs = pairs.copy()
+            pairs[self.pending[0], self.pending[1]] += 1
+
+        # Tracks number of m values and editors that reverted each other
+        m_val_dict = Counter()
+        mutual_revs_editors = set()
+        for (prev_editor, curr_editor), count in pairs.items():
+            m_val_dict[min(self.num_edits[prev_editor],
+                           self.num_edits[curr_editor])] += count
+            if (curr_editor, prev_editor) in pairs:
+                mutual_revs_editors.add(prev_editor)
+                mutual_revs_editors.add(curr_editor)
+
+        res_stats = []
+        if extra_stats:
+            res_stats.extend([self.rev_count, sum(m_val_dict.values()),
+                              len(self.num_edits), len(mutual_revs_editors)])
+        if not m_val_dict:
+            return [0] + res_stats
+        # Remove maximum pair(s)
+        del m_val_dict[max(m_val_dict)]
+        return [sum([k * v for k, v in m_val_dict.items()]) *
+                len(mutual_revs_editors)] + res_stats
+
+    def to_dict(self, after_editor=True):
+        """
+        :param after_editor: Whether or not to include after_editor, which
+                             snapshot stores keep in a file of its own
+        :return: JSON serializable state
+        """
+        state = {
+            'rev_count': self.rev_count, 'next_val': self.next_val,
+            'num_edits': list(self.num_edits.items()),
+            'last_mapped': self.last_mapped,
+            'pairs': [[prev_editor, curr_editor, count] for
+                      (prev_editor, curr_editor), count in self.pairs.items()],
+            'pending': self.pending
+        }
+        if after_editor:
+            state['after_editor'] = list(self.after_editor.items())
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: State from to_dict()
+        :return: Restored MStatState
+        """
+        m_stat_state = cls()
+        m_stat_state.rev_count = state['rev_count']
+        m_stat_state.next_val = state['next_val']
+        m_stat_state.num_edits = Counter(dict(state['num_edits']))
+        m_stat_state.after_editor = dict(state.get('after_editor', ()))
+        m_stat_state.last_mapped = state['last_mapped']
+        m_stat_state.pairs = Counter({
+            (prev_editor, curr_editor): count
+            for prev_editor, curr_editor, count in state['pairs']
+        })
+        if state['pending'] is not None:
+            m_stat_state.pending = tuple(state['pending'])
+        return m_stat_state
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for the Snapshot Store
+# ---------------------------------------------------------------------
+# Every article's snapshot store is three files:
+#   [store].jsonl -> one MStatState per line without its after_editor, the
+#                    first being the empty state before any revisions
+#   [store].after -> a fixed width record for every after_editor entry,
+#                    holding the offset of the editor in .names. Light dumps
+#                    number the edits that are not reverts 1, 2, 3..., so
+#                    the entry of edit number n is record n - 1, entries are
+#                    only ever added at the end, and each snapshot just
+#                    records how many records are its own. A single entry
+#                    is found by seeking instead of reading them all
+#   [store].names -> every editor of the article, one per line
+#   [store].idx   -> one line per snapshot with the timestamp of its last
+#                    revision, the number of revisions, the light dump offset
+#                    of its last revision line, its offset in the .jsonl file
+#                    and its number of .after records
+# The light dump lists revisions latest to earliest, so the revisions after a
+# snapshot are the lines between the next snapshot's offset and its own
+#
+# Queries restore a snapshot and replay at most snapshot_every revisions past
+# it, reading only the after_editor entries those revisions revert to. The
+# rest of a snapshot is the editors' edit counts and the revert pairs, which
+# grow with the number of editors rather than the number of revisions, and
+# which the M-Statistic itself goes through anyway
+#
+# grab_m_stat_over_time() keeps a store per extracted article:
+#   out_m_stat/snapshots-[article].jsonl/.after/.names/.idx
+# get_m_stat_data() keeps one for every long page in a light dump, keyed by
+# the offset of the page's title line, along with an index of every page:
+#   out_m_stat/snapshots-[dump]/[title offset].jsonl/.after/.names/.idx
+#   out_m_stat/snapshots-[dump]/pages.idx -> '[title offset] [page end]
+#                                            [revisions] [title]' per page
+
+# Record of an after_editor entry in the .after file
+AFTER_RECORD = struct.Struct('<Q')
+
+def get_store_name(fp):
+    """
+    i.e. light-dump-Anarchism.txt.gz -> Anarchism
+    :param fp: File name of the light dump
+    :return: Name of the light dump's snapshot store
+    """
+    return get_light_dump_name(fp).replace('.txt', '')\
+        .replace('light-dump-', '')
+
+
+def get_snapshot_fps(out_m_stat_dir, fp):
+    """
+    Gets the snapshot store file paths of an article's light dump
+    i.e. light-dump-Anarchism.txt -> snapshots-Anarchism.jsonl/.idx/...
+    :param out_m_stat_dir: Directory for M-Statistic output
+    :param fp: File name of the article's light dump
+    :return: File paths of the snapshots, their index, after_editor and
+             editor names
+    """
+    store = '{}snapshots-{}'.format(out_m_stat_dir, get_store_name(fp))
+    return (store + '.jsonl', store + '.idx', store + '.after',
+            store + '.names')
+
+
+def get_page_snapshot_dir(out_m_stat_dir, fp):
+    """
+    :param out_m_stat_dir: Directory for M-Statistic output
+    :param fp: File name of a light dump of many pages
+    :return: Directory of the snapshot stores of its pages
+    """
+    return '{}snapshots-{}/'.format(out_m_stat_dir, get_store_name(fp))
+
+
+def get_page_snapshot_fps(snapshot_dir, title_offset):
+    """
+    :param snapshot_dir: Directory from get_page_snapshot_dir()
+    :param title_offset: Light dump offset of the page's title line
+    :return: File paths of the page's snapshots, their index, after_editor
+             and editor names
+    """
+    store = '{}{}'.format(snapshot_dir, title_offset)
+    return (store + '.jsonl', store + '.idx', store + '.after',
+            store + '.names')
+
+
+class SnapshotWriter:
+    """
+    Writes the snapshot store of an article while its history is replayed
+    from earliest to latest
+    """
+
+    def __init__(self, fps, light_dump_end):
+        """
+        :param fps: File paths from get_snapshot_fps() or
+                    get_page_snapshot_fps()
+        :param light_dump_end: Light dump offset of the end of the article
+        """
+        fp_snapshots, fp_idx, fp_after, fp_names = fps
+        self.fh = open(fp_snapshots, 'w', encoding='utf-8')
+        self.idx_fh = open(fp_idx, 'w')
+        self.after_fh = open(fp_after, 'wb')
+        self.names_fh = open(fp_names, 'wb')
+        self.offset, self.after_count = 0, 0
+        # Offset of each editor's name in the .names file
+        self.name_offsets, self.names_offset = {}, 0
+        # Empty state sits after the earliest revision, at the end of the
+        # article
+        self.write(MStatState(), '', light_dump_end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, m_stat_state, timestamp, line_offset):
+        """
+        Writes a snapshot of the state
+        :param m_stat_state: Current MStatState
+        :param timestamp: Timestamp of the last revision in the state
+        :param line_offset: Light dump offset of the last revision's line
+        """
+        # after_editor entries are only ever added, so the ones since the
+        # last snapshot are the newest
+        after_editor = m_stat_state.after_editor
+        new_entries = list(islice(reversed(after_editor.items()),
+                                  len(after_editor) - self.after_count))
+        for rev, editor in reversed(new_entries):
+            if rev != self.after_count + 1:
+                raise ValueError('Edit numbers go {} then {}, not 1, 2, 3... '
+                                 'like in a light dump'.format(
+                                     self.after_count, rev))
+            self.after_count += 1
+            if editor not in self.name_offsets:
+                name = '{}\n'.format(editor).encode('utf-8')
+                self.names_fh.write(name)
+                self.name_offsets[editor] = self.names_offset
+                self.names_offset += len(name)
+            self.after_fh.write(AFTER_RECORD.pack(self.name_offsets[editor]))
+
+        line = json.dumps(m_stat_state.to_dict(after_editor=False)) + '\n'
+        self.idx_fh.write('{} {} {} {} {}\n'.format(
+            timestamp or '-', m_stat_state.rev_count, line_offset,
+            self.offset, self.after_count))
+        self.fh.write(line)
+        self.offset += len(line.encode('utf-8'))
+
+    def close(self):
+        self.fh.close()
+        self.idx_fh.close()
+        self.after_fh.close()
+        self.names_fh.close()
+
+
+class StoredAfterEditor(dict):
+    """
+    after_editor of a restored snapshot. Entries added after the snapshot
+    are kept like in any dictionary, while the snapshot's own entries are
+    only read from the store when get() asks for them
+    """
+
+    def __init__(self, fps, count):
+        """
+        :param fps: File paths of the store
+        :param count: Number of .after records of the snapshot
+        """
+        super().__init__()
+        _, _, self.fp_after, self.fp_names = fps
+        self.count = count
+
+    def get(self, rev, default=None):
+        if rev in self:
+            return self[rev]
+        editor = self.find(rev)
+        if editor is None:
+            return default
+        self[rev] = editor
+        return editor
+
+    def find(self, rev):
+        """
+        Finds the editor after an edit number in the .after records
+        :param rev: Edit number
+        :return: Editor or None if the edit number has no entry
+        """
+        if not 1 <= rev <= self.count:
+            return None
+        with open(self.fp_after, 'rb') as fh:
+            fh.seek((rev - 1) * AFTER_RECORD.size)
+            name_offset, = AFTER_RECORD.unpack(fh.read(AFTER_RECORD.size))
+        with open(self.fp_names, 'rb') as fh:
+            fh.seek(name_offset)
+            return fh.readline().decode('utf-8').rstrip('\n')
+
+
+def write_page_snapshots(fps, lines, page_end, snapshot_every):
+    """
+    Writes the snapshot store of a page by replaying its revisions
+    :param fps: File paths from get_page_snapshot_fps()
+    :param lines: Binary lines of the page, starting with its title line
+    :param page_end: Light dump offset of the end of the page
+    :param snapshot_every: Number of revisions between snapshots
+    """
+    line_offset = page_end
+    m_stat_state = MStatState()
+    with SnapshotWriter(fps, page_end) as snapshot_writer:
+        # Goes from the earliest revision to the latest
+        for line in reversed(lines):
+            line_offset -= len(line)
+            line = line.decode('utf-8').split()
+            if not line or line[0][:3] != '^^^' or line[0] == '^^^=':
+                continue
+            m_stat_state.update(int(line[2]), line[3])
+            if not m_stat_state.rev_count % snapshot_every:
+                snapshot_writer.write(m_stat_state, line[0][4:], line_offset)
+
+
+@lru_cache(maxsize=8)
+def load_page_index(fp_pages, mtime):
+    """
+    Loads the index of every page in a light dump
+    :param fp_pages: File path of pages.idx
+    :param mtime: Modification time of the file, so a rewritten index is
+                  loaded again
+    :return: Dictionary of title to (title offset, page end or None for the
+             end of the file, number of revisions)
+    """
+    pages = {}
+    with open(fp_pages, encoding='utf-8') as fh:
+        for line in fh:
+            title_offset, page_end, num_revs, title = \
+                line.rstrip('\n').split(' ', 3)
+            pages[title] = (int(title_offset),
+                            None if page_end == '-' else int(page_end),
+                            int(num_revs))
+    return pages
+
+
+def load_snapshot_index(fp_idx):
+    """
+    Loads the index of an article's snapshot store
+    :param fp_idx: File path of the index
+    :return: Timestamps, revision counts, light dump offsets, snapshot
+             offsets and after_editor record counts of every snapshot
+    """
+    timestamps, rev_counts, line_offsets, snapshot_offsets, after_counts = \
+        [], [], [], [], []
+    with open(fp_idx) as fh:
+        for line in fh:
+            line = line.split()
+            timestamps.append('' if line[0] == '-' else line[0])
+            rev_counts.append(int(line[1]))
+            line_offsets.append(int(line[2]))
+            snapshot_offsets.append(int(line[3]))
+            after_counts.append(int(line[4]))
+    return timestamps, rev_counts, line_offsets, snapshot_offsets, \
+        after_counts
+
+
+def load_snapshot(fps, snapshot_offset, after_count):
+    """
+    Loads a single snapshot from the store
+    :param fps: File paths of the store (None for a page without one)
+    :param snapshot_offset: Offset of the snapshot in the .jsonl file
+    :param after_count: Number of .after records of the snapshot
+    :return: MStatState, reading after_editor from the store as needed
+    """
+    if fps is None:
+        return MStatState()
+    with open(fps[0], 'rb') as fh:
+        fh.seek(snapshot_offset)
+        m_stat_state = MStatState.from_dict(json.loads(fh.readline()))
+    m_stat_state.after_editor = StoredAfterEditor(fps, after_count)
+    return m_stat_state
+
+
+def find_article(data_dir, fp, title=None):
+    """
+    Finds where an article's history and snapshot store are
+    :param data_dir: Directory for data
+    :param fp: File name of the article's light dump, or of a light dump
+               scored by get_m_stat_data() with snapshots when given a title
+    :param title: Title of the article within a light dump of many pages
+    :return: Light dump offset of the start of the article, the file paths
+             of its store (None when the page is too short to have one) and
+             the store's index
+    """
+    out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+    if title is None:
+        fps = get_snapshot_fps(out_m_stat_dir, fp)
+        return 0, fps, load_snapshot_index(fps[1])
+
+    snapshot_dir = get_page_snapshot_dir(out_m_stat_dir, fp)
+    fp_pages = snapshot_dir + 'pages.idx'
+    pages = load_page_index(fp_pages, os.path.getmtime(fp_pages))
+    if title not in pages:
+        raise KeyError('{} is not in {}'.format(title, fp))
+    title_offset, page_end, _ = pages[title]
+    fps = get_page_snapshot_fps(snapshot_dir, title_offset)
+    if os.path.exists(fps[1]):
+        return title_offset, fps, load_snapshot_index(fps[1])
+    # Short pages are replayed from the start, up to the end of the page
+    return title_offset, None, ([''], [0], [page_end], [0], [0])
+
+
+def normalize_query_time(timestamp):
+    """
+    Makes a query time comparable with light dump timestamps, with dates
+    standing for the end of that day
+    i.e. 2019-05-17 -> 2019-05-17T23:59:59Z
+    :param timestamp: Date or light dump formatted timestamp
+    :return: Light dump formatted timestamp
+    :raises ValueError: If it is neither
+    """
+    if len(timestamp) == 10:
+        timestamp += 'T23:59:59Z'
+    datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+    return timestamp
+
+
+def replay_m_stat(data_dir, fp, start, end, extra_stats=0, title=None):
+    """
+    Restores the latest snapshot at or before start and replays only the
+    revisions after it, up to end
+    :param data_dir: Directory for data
+    :param fp: File name of the article's light dump (or of the light dump
+               holding it when given a title)
+    :param start: Earliest timestamp of interest
+    :param end: Latest timestamp of interest
+    :param extra_stats: Flag for extra statistics
+    :param title: Title of the article within a light dump of many pages
+    :return: M-Statistic as of start and a list of (timestamp, M-Statistic)
+             for every revision after start up to end
+    """
+    out_dir = '{}out/'.format(data_dir)
+    article_start, fps, index = find_article(data_dir, fp, title)
+    timestamps, _, line_offsets, snapshot_offsets, after_counts = index
+
+    snapshot = bisect.bisect_right(timestamps, start) - 1
+    m_stat_state = load_snapshot(fps, snapshot_offsets[snapshot],
+                                 after_counts[snapshot])
+
+    res, start_stats = [], None
+    while True:
+        # Revisions up to the next snapshot, earliest first
+        seg_start = line_offsets[snapshot + 1] \
+            if snapshot + 1 < len(line_offsets) else article_start
+        seg_end = line_offsets[snapshot]
+        with open_light_dump(out_dir + fp, offset=seg_start,
+                             binary=True) as fh:
+            lines = fh.read(-1 if seg_end is None else seg_end - seg_start)\
+                .decode('utf-8').splitlines()
+
+        for line in reversed(lines):
+            # Skips title lines and the summaries of pruned pages
+            if '^^^' != line[:3] or '^^^=' == line[:4]:
+                continue
+            line = line.split()
+            timestamp = line[0][4:]
+            if timestamp > end:
+                break
+            if timestamp > start and start_stats is None:
+                start_stats = m_stat_state.m_stat(extra_stats)
+            m_stat_state.update(int(line[2]), line[3])
+            if timestamp > start:
+                res.append((timestamp, m_stat_state.m_stat(extra_stats)))
+        else:
+            # Carries on into the revisions after the next snapshot
+            snapshot += 1
+            if snapshot < len(line_offsets):
+                continue
+        break
+
+    if start_stats is None:
+        start_stats = m_stat_state.m_stat(extra_stats)
+    return start_stats, res
+
+
+def get_m_stat_at(data_dir, fp, timestamp, extra_stats=0, title=None):
+    """
+    Gets an article's M-Statistic as of a point in time
+    :param data_dir: Directory for data
+    :param fp: File name of the article's light dump (or of the light dump
+               holding it when given a title)
+    :param timestamp: Date or light dump formatted timestamp
+    :param extra_stats: Flag for extra statistics
+    :param title: Title of the article within a light dump of many pages
+    :return: M-Statistic and possibly extra statistics
+    """
+    timestamp = normalize_query_time(timestamp)
+    return replay_m_stat(data_dir, fp, timestamp, timestamp, extra_stats,
+                         title)[0]
+
+
+def get_m_stat_range(data_dir, fp, start, end, extra_stats=0, title=None):
+    """
+    Gets an article's M-Statistic after every revision within a time range
+    :param data_dir: Directory for data
+    :param fp: File name of the article's light dump (or of the light dump
+               holding it when given a title)
+    :param start: Date or light dump formatted timestamp to start from
+    :param end: Date or light dump formatted timestamp to end at
+    :param extra_stats: Flag for extra statistics
+    :param title: Title of the article within a light dump of many pages
+    :return: List of (timestamp, M-Statistic) starting with the M-Statistic
+             as of start
+    """
+    start, end = normalize_query_time(start), normalize_query_time(end)
+    start_stats, res = replay_m_stat(data_dir, fp, start, end, extra_stats,
+                                     title)
+    return [(start, start_stats)] + res
+
+
+# ---------------------------------------------------------------------
+# Driver Function for QUERYING M-STATISTIC SNAPSHOTS
+# ---------------------------------------------------------------------
+
+def query_m_stat(data_dir='data/', fp='light-dump-Anarchism.txt',
+                 timestamps=(), ranges=(), extra_stats=0, title=None):
+    """
+    Prints an article's M-Statistic at points in time and over time ranges
+    from its snapshot store (made by grab_m_stat_over_time(), or by
+    get_m_stat_data() with snapshot_every for any article in a light dump)
+    :param data_dir: Directory for data
+    :param fp: File name of the article's light dump (or of the light dump
+               holding it when given a title)
+    :param timestamps: Dates or timestamps to get the M-Statistic at
+    :param ranges: Pairs of start and end dates or timestamps
+    :param extra_stats: Flag for extra statistics
+    :param title: Title of the article within a light dump of many pages
+    """
+    name = fp if title is None else '{} in {}'.format(title, fp)
+    for timestamp in timestamps:
+        print('{} at {}: {}'.format(
+            name, timestamp, get_m_stat_at(data_dir, fp, timestamp,
+                                           extra_stats, title)))
+    for start, end in ranges:
+        print('{} from {} to {}:'.format(name, start, end))
+        for timestamp, stats in get_m_stat_range(data_dir, fp, start, end,
+                                                 extra_stats, title):
+            print('    {} {}'.format(timestamp, stats))
@@ -0,0 +1,360 @@
+import ast
+import hashlib
+import json
+import os
+from editors import get_editor_ids_fp
+from light_io import compression_suffixes, get_article_light_dump_name,\
+    get_compression, get_xml_light_dump_name, resolve_light_dump
+from m_stat import get_m_stat_name
+from snapshots import get_page_snapshot_dir, get_snapshot_fps
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for Tracking Stages
+# ---------------------------------------------------------------------
+# Every stage run by run.py that declares its files is recorded in the stage
+# manifest once it finishes:
+#   {"[driver] [params]": {"params": [hash of driver and params],
+#                          "inputs": {[fp]: [size, mtime]},
+#                          "outputs": {[fp]: [size, mtime]},
+#                          "seconds": [time taken]}}
+# A stage is up to date while its params hash and the size/mtime of each of
+# its inputs and outputs match the record, the same way make compares mtimes
+# (hashing the contents of every dump on each run would cost as much as
+# some of the stages themselves). Param files are compared by their contents
+# and so is the code: the params hash covers the source of the driver's
+# module and of every src/ module it imports, so editing the scoring or the
+# conversion reruns the stages that use it
+
+# Directory of the library code, which modules import by top-level name
+SRC_DIR = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+def get_src_imports(fp):
+    """
+    :param fp: File path of a module in src/
+    :return: Names of the src/ modules it imports, anywhere in the module
+    """
+    with open(fp, 'rb') as fh:
+        tree = ast.parse(fh.read(), fp)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module \
+                and not node.level:
+            names.add(node.module)
+    names = {name[len('src.'):] if name.startswith('src.') else name
+             for name in names}
+    return {name for name in names
+            if os.path.exists('{}{}.py'.format(SRC_DIR, name))}
+
+
+def hash_code(module):
+    """
+    Hashes the source of a module and every src/ module it imports
+    :param module: Module of a driver, i.e. 'src.m_stat'
+    :return: Hash of the source files
+    """
+    module = module[len('src.'):] if module.startswith('src.') else module
+    seen, to_visit = set(), [module]
+    while to_visit:
+        name = to_visit.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        to_visit.extend(get_src_imports('{}{}.py'.format(SRC_DIR, name)))
+    code_hash = hashlib.sha256()
+    for name in sorted(seen):
+        with open('{}{}.py'.format(SRC_DIR, name), 'rb') as fh:
+            code_hash.update(name.encode('utf-8') + b'\0' + fh.read())
+    return code_hash.hexdigest()
+
+def get_fingerprint(fp):
+    """
+    Gets what is compared of a file to tell whether it changed
+    :param fp: File path, or directory path ending in '/'
+    :return: Size and mtime of the file (True for an existing directory),
+             or None if it does not exist
+    """
+    if fp.endswith('/'):
+        return True if os.path.isdir(fp) else None
+    try:
+        stat = os.stat(fp)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_fingerprints(fps):
+    """
+    :param fps: File paths
+    :return: Dictionary of each file path to its fingerprint
+    """
+    return {fp: get_fingerprint(fp) for fp in fps}
+
+
+def hash_params(driver, cfg):
+    """
+    :param driver: Driver given as 'module:function'
+    :param cfg: Params of the stage, with the driver's defaults filled in
+    :return: Hash of the driver, its params and its code
+    """
+    return hashlib.sha256(json.dumps(
+        [driver, cfg, hash_code(driver.split(':')[0])], sort_keys=True,
+        default=sorted).encode('utf-8')).hexdigest()
+
+
+def load_stage_manifest(fp):
+    """
+    :param fp: File path of the stage manifest
+    :return: Records of the stages run before, by stage name
+    """
+    if not os.path.exists(fp):
+        return {}
+    with open(fp) as fh:
+        return json.load(fh)
+
+
+def save_stage_manifest(fp, manifest):
+    """
+    Atomically writes the stage manifest, so a crash mid-write never loses
+    the records of earlier stages
+    :param fp: File path of the stage manifest
+    :param manifest: Records of the stages, by stage name
+    """
+    out_dir = os.path.dirname(fp)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(fp + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(fp + '.tmp', fp)
+
+
+def is_up_to_date(record, params_hash, files):
+    """
+    Checks whether a stage can be skipped
+    :param record: Record of the stage's last run (None if never run)
+    :param params_hash: Hash of the stage's driver and params
+    :param files: Input and output files of the stage from its io function
+    :return: Whether or not the stage's outputs are up to date
+    """
+    if record is None or record['params'] != params_hash:
+        return False
+    # A missing input has to be made (or fail) again, never skipped
+    inputs = get_fingerprints(files['inputs'])
+    if None in inputs.values() or record['inputs'] != inputs:
+        return False
+    if None in get_fingerprints(files['outputs']).values():
+        return False
+    return record['outputs'] == get_fingerprints(record['outputs'])
+
+
+def make_record(params_hash, files, seconds):
+    """
+    :param params_hash: Hash of the stage's driver and params
+    :param files: Input and output files of the stage, found after it ran
+    :param seconds: Time taken by the stage
+    :return: Record of the stage for the stage manifest
+    """
+    return {'params': params_hash,
+            'inputs': get_fingerprints(files['inputs']),
+            'outputs': get_fingerprints(files['outputs']),
+            'seconds': round(seconds, 3)}
+
+
+def paths_overlap(fps_a, fps_b):
+    """
+    Checks whether any file paths are the same or within a directory of the
+    other list
+    :param fps_a: File and directory paths (directories end in '/')
+    :param fps_b: File and directory paths (directories end in '/')
+    :return: Whether or not the lists overlap
+    """
+    for fp_a in fps_a:
+        for fp_b in fps_b:
+            if fp_a == fp_b or (fp_a.endswith('/') and
+                                fp_b.startswith(fp_a)) or \
+                    (fp_b.endswith('/') and fp_a.startswith(fp_b)):
+                return True
+    return False
+
+
+def depends_on(files, prev_files):
+    """
+    Checks whether a stage has to wait on an earlier stage: when it reads or
+    writes what the earlier stage writes, or writes what it reads
+    :param files: Files of the stage
+    :param prev_files: Files of the earlier stage
+    :return: Whether or not the stage depends on the earlier stage
+    """
+    written = prev_files['outputs'] + prev_files['shared']
+    return paths_overlap(written, files['inputs'] + files['outputs'] +
+                         files['shared']) or \
+        paths_overlap(prev_files['inputs'],
+                      files['outputs'] + files['shared'])
+
+
+# ---------------------------------------------------------------------
+# Input and Output Files of Each Driver
+# ---------------------------------------------------------------------
+# Each io function takes the params of its driver with the defaults filled
+# in, and gives the files the stage reads ('inputs') and writes ('outputs'),
+# plus files it updates that are shared by other stages ('shared'), like the
+# editor dictionary. Shared files keep stages from running at the same time
+# but are not compared, since every stage appends to them
+
+def get_data_io(data_dir, fps, fp_type, unzip_type, **_):
+    """
+    Files of get_data(). The unzipped files are only known once the archive
+    is downloaded, until then the directory they are unzipped to stands in
+    """
+    raw_dir = data_dir + 'raw/'
+    unzip_dir = data_dir + ('out/' if unzip_type else 'temp/')
+    inputs, outputs = [], []
+    for fp in fps:
+        fp_zip = fp.split('/')[-1]
+        if fp_type == 1:
+            inputs.append(data_dir + fp if os.path.exists(data_dir + fp)
+                          else fp)
+        outputs.append(raw_dir + fp_zip)
+        if os.path.exists(raw_dir + fp_zip):
+            from etl import get_archive_names
+            outputs += [unzip_dir + name
+                        for name in get_archive_names(raw_dir + fp_zip)]
+        else:
+            outputs.append(unzip_dir)
+    return {'inputs': inputs, 'outputs': outputs, 'shared': []}
+
+
+def get_light_dump_formats(fp):
+    """
+    :param fp: File path of a light dump, with or without suffix
+    :return: File paths of the light dump in every format, plus the block
+             indexes of the compressed ones
+    """
+    for suffix in compression_suffixes.values():
+        if fp.endswith(suffix):
+            fp = fp[:-len(suffix)]
+    fps = [fp]
+    for suffix in compression_suffixes.values():
+        fps += [fp + suffix, fp + suffix + '.idx']
+    return fps
+
+
+def get_light_dump_inputs(fp):
+    """
+    Gets the files a driver reads for a light dump, the same way it finds
+    the light dump with resolve_light_dump()
+    :param fp: File path of a light dump, with or without suffix
+    :return: File paths of the light dump on disk (and its block index), or
+             of every format when it is not there yet
+    """
+    fp = resolve_light_dump(fp)
+    if not os.path.exists(fp):
+        return get_light_dump_formats(fp)
+    return [fp, fp + '.idx'] if get_compression(fp) else [fp]
+
+
+def get_xml_light_dump_fps(out_dir, fps, compression):
+    """
+    :param out_dir: Output directory
+    :param fps: File names of the unzipped XML files
+    :param compression: Compression of the light dumps
+    :return: File paths of the light dumps and their block indexes, and of
+             the other formats removed when writing them
+    """
+    suffix = compression_suffixes.get(compression, '')
+    out_fps, removed_fps = [], []
+    for fp in fps:
+        out_fp = out_dir + get_xml_light_dump_name(fp)
+        written = [out_fp + suffix] + ([out_fp + suffix + '.idx']
+                                       if suffix else [])
+        out_fps += written
+        removed_fps += [other_fp for other_fp in
+                        get_light_dump_formats(out_fp)
+                        if other_fp not in written]
+    return out_fps, removed_fps
+
+
+def process_data_io(data_dir, fps, out_format, compression, title_list_fp,
+                    **_):
+    """
+    Files of process_data()
+    """
+    out_fps, removed_fps = get_xml_light_dump_fps(
+        '{}out/'.format(data_dir), fps, None if out_format else compression
+    )
+    return {
+        'inputs': ['{}temp/{}'.format(data_dir, fp) for fp in fps] +
+                  ([title_list_fp] if title_list_fp else []),
+        'outputs': out_fps,
+        'shared': [get_editor_ids_fp(data_dir)] + removed_fps
+    }
+
+
+def extract_article_io(data_dir, fps, desired_articles, **_):
+    """
+    Files of extract_article()
+    """
+    out_dir = '{}out/'.format(data_dir)
+    return {'inputs': [in_fp for fp in fps
+                       for in_fp in get_light_dump_inputs(out_dir + fp)],
+            'outputs': [out_dir + get_article_light_dump_name(title)
+                        for title in desired_articles],
+            'shared': []}
+
+
+def get_m_stat_data_io(data_dir, fps, snapshot_every, **_):
+    """
+    Files of get_m_stat_data()
+    """
+    out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+    outputs = []
+    for fp in fps:
+        outputs.append(out_m_stat_dir + get_m_stat_name(fp))
+        if snapshot_every:
+            outputs.append(get_page_snapshot_dir(out_m_stat_dir, fp) +
+                           'pages.idx')
+    return {'inputs': [in_fp for fp in fps for in_fp in
+                       get_light_dump_inputs('{}out/{}'.format(data_dir, fp))],
+            'outputs': outputs,
+            'shared': [get_editor_ids_fp(data_dir)]}
+
+
+def get_m_stat_from_xml_io(data_dir, fps, light_dump, compression,
+                           title_list_fp, **_):
+    """
+    Files of get_m_stat_from_xml()
+    """
+    outputs = ['{}out_m_stat/{}'.format(
+        data_dir, get_m_stat_name(get_xml_light_dump_name(fp)))
+        for fp in fps]
+    shared = [get_editor_ids_fp(data_dir)]
+    if light_dump:
+        out_fps, removed_fps = get_xml_light_dump_fps(
+            '{}out/'.format(data_dir), fps, compression)
+        outputs += out_fps
+        shared += removed_fps
+    return {
+        'inputs': ['{}temp/{}'.format(data_dir, fp) for fp in fps] +
+                  ([title_list_fp] if title_list_fp else []),
+        'outputs': outputs,
+        'shared': shared
+    }
+
+
+def grab_m_stat_over_time_io(data_dir, fps, snapshot_every, **_):
+    """
+    Files of grab_m_stat_over_time()
+    """
+    out_m_stat_dir = '{}out_m_stat/'.format(data_dir)
+    outputs = []
+    for fp in fps:
+        outputs.append(out_m_stat_dir +
+                       get_m_stat_name(fp, prefix='overtime-'))
+        if snapshot_every:
+            outputs += get_snapshot_fps(out_m_stat_dir, fp)
+    return {'inputs': [in_fp for fp in fps for in_fp in
+                       get_light_dump_inputs('{}out/{}'.format(data_dir, fp))],
+            'outputs': outputs, 'shared': []}
@@ -0,0 +1,349 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from csv import reader, writer
+from multiprocessing import Process
+from light_io import get_xml_light_dump_name
+from m_stat import get_m_stat_from_xml, get_m_stat_name
+
+
+# ---------------------------------------------------------------------
+# Helper Functions for the Work Queue
+# ---------------------------------------------------------------------
+# The queue directory lives on a filesystem shared by every worker:
+#   queue_dir/claims/[part].lock  -> claim held by a worker, kept fresh by
+#                                    heartbeats (the lock's mtime)
+#   queue_dir/done/[part]         -> marker for finished parts
+#   queue_dir/out_m_stat/         -> m-stat-[part].csv for every part and the
+#                                    merged output
+# Each worker does the actual processing in its own local work directory,
+# work_dir/[worker id]/[part]/, so workers on one machine never share one
+
+def load_manifest(manifest_fp):
+    """
+    Loads the manifest of dump parts
+    Example manifest:
+        {"queue_dir": "data/queue/", "work_dir": "data/work/",
+         "parts": [{"fp": "https://dumps.wikimedia.org/...7z", "fp_type": 0}],
+         "stale_after": 600, "heartbeat_every": 60, "extra_stats": 0}
+    :param manifest_fp: File path of the manifest
+    :return: Manifest with defaults filled in
+    """
+    with open(manifest_fp) as fh:
+        manifest = json.load(fh)
+
+    manifest.setdefault('work_dir', 'data/work/')
+    manifest.setdefault('stale_after', 600)
+    manifest.setdefault('heartbeat_every', 60)
+    manifest.setdefault('extra_stats', 0)
+    for part in manifest['parts']:
+        part.setdefault('fp_type', 0)
+        part.setdefault('name', get_part_xml(part['fp']).replace('.', '-'))
+    return manifest
+
+
+def get_part_m_stat_name(part):
+    """
+    Gets the file name of a part's M-Statistics in the shared output
+    i.e. enwiki-20200201-pages-meta-history1-xml-p1037p2028
+         -> m-stat-enwiki-20200201-pages-meta-history1-xml-p1037p2028.csv
+    :param part: Part from the manifest
+    :return: File name of the part's M-Statistic csv
+    """
+    return get_m_stat_name(get_xml_light_dump_name(part['name']))
+
+
+def get_part_xml(fp):
+    """
+    Gets the name of the unzipped XML file of a dump part
+    i.e. .../enwiki-20200201-pages-meta-history1.xml-p1037p2028.7z
+         -> enwiki-20200201-pages-meta-history1.xml-p1037p2028
+    :param fp: File path/URL of the dump part
+    :return: File name of the XML file
+    """
+    fp = fp.split('/')[-1]
+    for ext in ('.7z', '.zip'):
+        if fp.endswith(ext):
+            return fp[:-len(ext)]
+    return fp
+
+
+def get_queue_dirs(queue_dir):
+    """
+    Makes the sub-directories of the queue directory
+    :param queue_dir: Shared queue directory
+    :return: Claims, done and output directories
+    """
+    dirs = ['{}claims/'.format(queue_dir), '{}done/'.format(queue_dir),
+            '{}out_m_stat/'.format(queue_dir)]
+    for curr_dir in dirs:
+        os.makedirs(curr_dir, exist_ok=True)
+    return dirs
+
+
+def try_claim(lock_fp, worker_id, stale_after):
+    """
+    Tries to claim a part by atomically creating its lock file, taking over
+    the claim if its worker stopped heartbeating
+    :param lock_fp: File path of the part's lock
+    :param worker_id: Id of the current worker
+    :param stale_after: Seconds without a heartbeat before a claim is stale
+    :return: Whether or not the part was claimed
+    """
+    try:
+        fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        stale_fp = '{}.stale-{}'.format(lock_fp, worker_id)
+        try:
+            owner = get_claim(lock_fp)
+            if time.time() - os.path.getmtime(lock_fp) < stale_after:
+                return False
+            # Only one worker can win the rename of a stale claim
+            os.rename(lock_fp, stale_fp)
+        except FileNotFoundError:
+            return False
+        # Another worker may have reclaimed it and made a fresh claim between
+        # the check and the rename, in which case the fresh claim is put
+        # back, unless yet another claim has been made since
+        if get_claim(stale_fp) != owner or \
+                time.time() - os.path.getmtime(stale_fp) < stale_after:
+            try:
+                os.link(stale_fp, lock_fp)
+            except FileExistsError:
+                pass
+            os.remove(stale_fp)
+            return False
+        print('Reclaiming stale claim', lock_fp)
+        os.remove(stale_fp)
+        return try_claim(lock_fp, worker_id, stale_after)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(worker_id)
+    return True
+
+
+def get_claim(lock_fp):
+    """
+    :param lock_fp: File path of the part's lock
+    :return: Id of the worker holding the claim (None if unclaimed)
+    """
+    try:
+        with open(lock_fp) as fh:
+            return fh.read()
+    except FileNotFoundError:
+        return None
+
+
+def holds_claim(lock_fp, worker_id):
+    """
+    Checks that the current worker still holds a claim
+    :param lock_fp: File path of the part's lock
+    :param worker_id: Id of the current worker
+    :return: Whether or not the claim is still held
+    """
+    return get_claim(lock_fp) == worker_id
+
+
+def heartbeat(lock_fp, worker_id, heartbeat_every, stop):
+    """
+    Keeps a claim fresh by touching its lock until stopped
+    :param lock_fp: File path of the part's lock
+    :param worker_id: Id of the current worker
+    :param heartbeat_every: Seconds between heartbeats
+    :param stop: Event set once the part is finished
+    """
+    while not stop.wait(heartbeat_every):
+        if not holds_claim(lock_fp, worker_id):
+            print('Lost claim', lock_fp)
+            return
+        os.utime(lock_fp)
+
+
+def process_part(part, work_dir, out_m_stat_dir, extra_stats, lock_fp,
+                 worker_id):
+    """
+    Downloads, processes and scores a single dump part in a local work
+    directory, then moves its M-Statistics to the shared output directory
+    as long as the worker still holds its claim
+    :param part: Part from the manifest
+    :param work_dir: Local work directory
+    :param out_m_stat_dir: Shared output directory
+    :param extra_stats: Flag for extra statistics
+    :param lock_fp: File path of the part's lock
+    :param worker_id: Id of the current worker
+    :return: Whether or not the output was published
+    """
+    from etl import get_data
+
+    data_dir = '{}{}/{}/'.format(work_dir, worker_id, part['name'])
+    fp_unzip = get_part_xml(part['fp'])
+
+    get_data(data_dir=data_dir, fps=[part['fp']], fp_type=part['fp_type'])
+    shutil.rmtree(data_dir + 'raw', ignore_errors=True)
+    get_m_stat_from_xml(data_dir=data_dir, fps=[fp_unzip],
+                        extra_stats=extra_stats)
+
+    # Another worker took the part over, so its output is left to them
+    if not holds_claim(lock_fp, worker_id):
+        print('{} lost its claim on {}, not publishing'.format(
+            worker_id, part['name']))
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return False
+
+    # Copies then renames so the shared output only ever holds whole files
+    fp_out = out_m_stat_dir + get_part_m_stat_name(part)
+    fp_tmp = '{}.tmp-{}'.format(fp_out, worker_id)
+    shutil.copyfile(
+        '{}out_m_stat/{}'.format(
+            data_dir, get_m_stat_name(get_xml_light_dump_name(fp_unzip))),
+        fp_tmp
+    )
+    os.replace(fp_tmp, fp_out)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return True
+
+
+def remove_worker_dir(work_dir, worker_id):
+    """
+    Removes the worker's own work directory once it has no parts left in it
+    :param work_dir: Local work directory
+    :param worker_id: Id of the current worker
+    """
+    try:
+        os.rmdir('{}{}/'.format(work_dir, worker_id))
+    except OSError:
+        pass
+
+
+# ---------------------------------------------------------------------
+# Driver Function for RUNNING A WORKER ON THE SHARED QUEUE
+# ---------------------------------------------------------------------
+
+def run_worker(manifest_fp='config/deep-search/manifest.json',
+               worker_id=None, wait=0):
+    """
+    Claims and processes dump parts from the shared queue until none are
+    left. Any number of workers on any number of machines can run at once
+    :param manifest_fp: File path of the manifest
+    :param worker_id: Id of the worker (defaults to host name and pid)
+    :param wait: Whether or not to wait on parts claimed by other workers,
+                 reclaiming them if their worker dies
+    """
+    manifest = load_manifest(manifest_fp)
+    claims_dir, done_dir, out_m_stat_dir = \
+        get_queue_dirs(manifest['queue_dir'])
+    if worker_id is None:
+        worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+    while True:
+        claimed, remaining = 0, 0
+        for part in manifest['parts']:
+            if os.path.exists(done_dir + part['name']):
+                continue
+            remaining += 1
+            lock_fp = '{}{}.lock'.format(claims_dir, part['name'])
+            if not try_claim(lock_fp, worker_id, manifest['stale_after']):
+                continue
+            # Another worker may have finished it since we checked
+            if os.path.exists(done_dir + part['name']):
+                os.remove(lock_fp)
+                continue
+
+            claimed += 1
+            print('{} claimed {}'.format(worker_id, part['name']))
+            stop = threading.Event()
+            beat = threading.Thread(
+                target=heartbeat, daemon=True,
+                args=(lock_fp, worker_id, manifest['heartbeat_every'], stop)
+            )
+            beat.start()
+            try:
+                if process_part(part, manifest['work_dir'], out_m_stat_dir,
+                                manifest['extra_stats'], lock_fp, worker_id):
+                    open(done_dir + part['name'], 'w').close()
+                    print('{} finished {}'.format(worker_id, part['name']))
+            finally:
+                stop.set()
+                beat.join()
+                if holds_claim(lock_fp, worker_id):
+                    os.remove(lock_fp)
+
+        if not remaining:
+            print('{} found no parts left'.format(worker_id))
+            remove_worker_dir(manifest['work_dir'], worker_id)
+            return
+        if not claimed:
+            if not wait:
+                print('{} left {} parts to other workers'.format(
+                    worker_id, remaining))
+                remove_worker_dir(manifest['work_dir'], worker_id)
+                return
+            time.sleep(manifest['heartbeat_every'])
+
+
+# ---------------------------------------------------------------------
+# Driver Function for MERGING THE M-STATISTICS OF EVERY PART
+# ---------------------------------------------------------------------
+
+def merge_m_stats(manifest_fp='config/deep-search/manifest.json',
+                  out_fp='m-stat-merged.csv'):
+    """
+    Merges the M-Statistics of every part in manifest order, assigning
+    global Title_IDs
+    :param manifest_fp: File path of the manifest
+    :param out_fp: File name of the merged output within the queue's
+                   out_m_stat directory
+    :raises RuntimeError: If any part is not done yet
+    """
+    manifest = load_manifest(manifest_fp)
+    _, done_dir, out_m_stat_dir = get_queue_dirs(manifest['queue_dir'])
+
+    missing = [part['name'] for part in manifest['parts']
+               if not os.path.exists(done_dir + part['name'])]
+    if missing:
+        raise RuntimeError('Not merging, still waiting on {}'.format(missing))
+
+    page_count = 0
+    with open(out_m_stat_dir + out_fp + '.tmp', 'w', newline='') as out_fh:
+        out_csv_writer = writer(out_fh)
+        for i, part in enumerate(manifest['parts']):
+            with open(out_m_stat_dir + get_part_m_stat_name(part),
+                      newline='') as in_fh:
+                in_csv_reader = reader(in_fh)
+                header = next(in_csv_reader, None)
+                if header and not i:
+                    out_csv_writer.writerow(header)
+                for row in in_csv_reader:
+                    row[0] = page_count
+                    out_csv_writer.writerow(row)
+                    page_count += 1
+    os.replace(out_m_stat_dir + out_fp + '.tmp', out_m_stat_dir + out_fp)
+    print('Merged {} pages into {}'.format(page_count,
+                                           out_m_stat_dir + out_fp))
+
+
+# ---------------------------------------------------------------------
+# Driver Function for RUNNING SEVERAL LOCAL WORKERS
+# ---------------------------------------------------------------------
+
+def run_local_workers(manifest_fp='config/test/manifest.json', num_workers=3):
+    """
+    Runs several worker processes against the queue and merges the output,
+    for trying out the queue on one machine
+    :param manifest_fp: File path of the manifest
+    :param num_workers: Number of worker processes
+    """
+    workers = [Process(target=run_worker,
+                       kwargs={'manifest_fp': manifest_fp, 'wait': 1})
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.exitcode for worker in workers if worker.exitcode]
+    if failed:
+        raise RuntimeError('{} of {} workers failed with exit codes {}'
+                           .format(len(failed), num_workers, failed))
+    merge_m_stats(manifest_fp=manifest_fp)